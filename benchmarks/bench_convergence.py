@@ -0,0 +1,189 @@
+#convergence benchmark, simulated time until a failed node is withdrawn from every routing table, time until
+#the routing tables are stable and route update messages sent after the node fails, on ring and mesh topologies, with plain distance vector (no split horizon, no hold-down)
+#and with split horizon, poison reverse and hold-down, and in link state mode
+#usage: python benchmarks/bench_convergence.py [nodes]
+
+import os
+import sys
+import io
+import heapq
+import random
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import cchat
+
+link_delay = 0.005 # seconds
+
+#event loop with simulated time, enough of asyncio for the routing manager timers
+class SimulatedLoop(object):
+
+    def __init__(self):
+        self.clock = 0.0
+        self.events = []
+        self.counter = 0
+
+    def time(self):
+        return self.clock
+
+    def call_later(self, delay, callback, *args):
+        handle = SimulatedHandle(callback, args)
+        self.counter += 1
+        heapq.heappush(self.events, (self.clock + delay, self.counter, handle))
+        return handle
+
+    def run(self, limit):
+        while len(self.events) > 0 and self.events[0][0] <= limit:
+            (self.clock, counter, handle) = heapq.heappop(self.events)
+            if not handle.cancelled:
+                handle.callback(*handle.args)
+
+class SimulatedHandle(object):
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class SimulatedSendReceive(object):
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def now(self):
+        return int(self.loop.time() * 1000)
+
+    #neighbour liveness is not simulated, failures are announced by fail()
+    def watch_neighbour(self, neighbour):
+        pass
+
+#stands in for the PacketManager, route update messages are delivered to the other node after link_delay
+class SimulatedNode(object):
+
+    def __init__(self, network, longid, link_state):
+        self.network = network
+        self.longid = longid
+        self.routing_manager = cchat.RoutingManager(SimulatedSendReceive(network.loop), longid, link_state)
+        self.routing_manager.set_packet_manager(self)
+
+    def request_send_routing_update(self, isFull, destination, routes):
+        self.network.deliver(self.longid, destination, lambda node: node.receive_routing_update(self.longid, routes))
+
+    def request_send_fullrouting_update(self, destination):
+        self.network.deliver(self.longid, destination, lambda node: node.request_send_routing_update(True, \
+            self.longid, node.routing_manager.get_routing_table(self.longid)))
+
+    def request_send_link_state(self, destination, advertisement):
+        self.network.deliver(self.longid, destination, lambda node: node.routing_manager.receive_link_state( \
+            self.longid, *advertisement))
+
+    def request_send_identity(self, destination):
+        pass
+
+    #same as PacketManager does with a RouteUpdateMessage
+    def receive_routing_update(self, source, routes):
+        routing_table = [{"DESTINATIONID": destination, "NEXTHOPID": source, "HOPCOUNT": hopcount} \
+            for (destination, hopcount) in routes]
+        if len(routing_table) > 0:
+            self.routing_manager.compare_tables(routing_table)
+        else:
+            self.routing_manager.remove_node(source)
+
+class SimulatedNetwork(object):
+
+    def __init__(self, count, links, link_state=False):
+        self.loop = SimulatedLoop()
+        self.nodes = {}
+        self.links = set()
+        self.messages = 0
+        self.last_change = 0.0
+        self.failed = None
+        self.last_withdraw = 0.0
+        for i in range(1, count + 1):
+            longid = i.to_bytes(8, byteorder='big')
+            self.nodes[longid] = SimulatedNode(self, longid, link_state)
+        for (a, b) in links:
+            self.connect(a.to_bytes(8, byteorder='big'), b.to_bytes(8, byteorder='big'))
+
+    def connect(self, a, b):
+        self.links.add((a, b))
+        self.links.add((b, a))
+        self.nodes[a].routing_manager.add_neighbour(("sim", 0), b)
+        self.nodes[b].routing_manager.add_neighbour(("sim", 0), a)
+
+    def deliver(self, source, destination, action):
+        if (source, destination) not in self.links:
+            return
+        self.messages += 1
+        def receive():
+            node = self.nodes.get(destination)
+            if node != None and (source, destination) in self.links:
+                before = dict(node.routing_manager.distance_table)
+                action(node)
+                if node.routing_manager.distance_table != before:
+                    self.last_change = self.loop.time()
+                if self.failed in before and self.failed not in node.routing_manager.distance_table:
+                    self.last_withdraw = self.loop.time()
+        self.loop.call_later(link_delay, receive)
+
+    #node fails, its neighbours notice and remove it
+    def fail(self, longid):
+        self.failed = longid
+        for (a, b) in list(self.links):
+            if longid in (a, b):
+                self.links.discard((a, b))
+        del self.nodes[longid]
+        for node in self.nodes.values():
+            if longid in node.routing_manager.neighbors:
+                node.routing_manager.remove_node(longid)
+
+def ring(count):
+    return [(i, i % count + 1) for i in range(1, count + 1)]
+
+def mesh(count):
+    random.seed(count)
+    links = set(ring(count))
+    while len(links) < count * 2:
+        (a, b) = random.sample(range(1, count + 1), 2)
+        if (b, a) not in links:
+            links.add((a, b))
+    return sorted(links)
+
+#simulated seconds until the failed node is withdrawn and until the routes are stable, messages sent,
+#and whether the failed node is gone from every routing table
+def run(count, links, split_horizon, hold_down_time, link_state):
+    cchat.RoutingManager.split_horizon = split_horizon
+    cchat.RoutingManager.hold_down_time = hold_down_time
+    #the routing manager prints every change
+    with contextlib.redirect_stdout(io.StringIO()):
+        network = SimulatedNetwork(count, links, link_state)
+        network.loop.run(60)
+        failed = (1).to_bytes(8, byteorder='big')
+        start = network.loop.time()
+        network.messages = 0
+        network.last_change = start
+        network.last_withdraw = start
+        network.fail(failed)
+        #link state advertisements are refreshed forever, stop before the first refresh
+        network.loop.run(start + min(600, cchat.RoutingManager.lsa_refresh_interval / 1000 - 1))
+    converged = all(failed not in node.routing_manager.distance_table for node in network.nodes.values())
+    return (network.last_withdraw - start, network.last_change - start, network.messages, converged)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    saved = (cchat.RoutingManager.split_horizon, cchat.RoutingManager.hold_down_time)
+    print("{: >6} {: >6} {: >24} {: >13} {: >10} {: >10} {: >10}".format("topo", "nodes", "mode", "withdrawn (s)", \
+        "stable (s)", "messages", "converged"))
+    for (name, links) in (("ring", ring(count)), ("mesh", mesh(count))):
+        for (mode, split_horizon, hold_down_time, link_state) in (("plain", False, 0, False), \
+            ("split horizon+hold-down", True, saved[1], False), ("link state", True, saved[1], True)):
+            (withdrawn, stable, messages, converged) = run(count, links, split_horizon, hold_down_time, link_state)
+            print("{: >6} {: >6} {: >24} {: >13.2f} {: >10.2f} {: >10} {: >10}".format(name, count, mode, withdrawn, \
+                stable, messages, str(converged)))
+    (cchat.RoutingManager.split_horizon, cchat.RoutingManager.hold_down_time) = saved
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#relay benchmark, time a relay node spends per transit packet, with the forwarding fast path (cut_through)
+#and with the normal path (decode, ack, routing, send buffer, encode)
+#usage: python benchmarks/bench_forwarding.py [packets]
+
+import io
+import os
+import sys
+import time
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import cchat
+
+source = (1).to_bytes(8, byteorder='big')
+relay = (2).to_bytes(8, byteorder='big')
+destination = (3).to_bytes(8, byteorder='big')
+
+#transport that only counts the datagrams
+class CountingTransport(object):
+
+    def __init__(self):
+        self.sent = 0
+
+    def sendto(self, data, addr):
+        self.sent += 1
+
+#relay node between source and destination, wired like main() does, without a socket
+def build(cut_through):
+    send_receive = cchat.SendAndReceive(("localhost", 5002), relay, "relay")
+    send_receive.cut_through = cut_through
+    routing_manager = cchat.RoutingManager(send_receive, relay)
+    packet_manager = cchat.PacketManager(routing_manager, relay, "relay")
+    routing_manager.set_packet_manager(packet_manager)
+    send_receive.set_routing_manager(routing_manager)
+    send_receive.set_packet_manager(packet_manager)
+    for (longid, port) in ((source, 5001), (destination, 5003)):
+        send_receive.neighbours[longid] = ("localhost", port)
+        routing_manager.add_neighbour(("localhost", port), longid)
+    send_receive.transport = CountingTransport()
+    send_receive.flush_send_buffer()
+    return send_receive
+
+def run(packets, cut_through):
+    with contextlib.redirect_stdout(io.StringIO()):
+        send_receive = build(cut_through)
+        #fragments of 800 fragment messages, seq is 16 bits
+        datagrams = [cchat.Packet(0x06, 0x00, source, destination, (i // 800) % 256, (i % 800 + 1) * 80, \
+            bytes(80)).encode() for i in range(packets)]
+        start = time.perf_counter()
+        for (i, datagram) in enumerate(datagrams):
+            send_receive.receive(memoryview(datagram), ("127.0.0.1", 5001))
+            #the event loop would drain the send buffer after every receive batch
+            if i % 64 == 63:
+                send_receive.flush_send_buffer()
+        send_receive.flush_send_buffer()
+        elapsed = time.perf_counter() - start
+    send_receive.loop.close()
+    return (elapsed / packets * 1000000, send_receive.transport.sent)
+
+def main():
+    packets = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print("{: >10} {: >16} {: >10} {: >14}".format("path", "us per packet", "datagrams", "packets/s"))
+    for (name, cut_through) in (("normal", False), ("fast path", True)):
+        (per_packet, sent) = run(packets, cut_through)
+        print("{: >10} {: >16.2f} {: >10} {: >14.0f}".format(name, per_packet, sent, 1000000 / per_packet))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+#micro-benchmarks of the hot paths: packet encode and decode, fragmenting and reassembling messages,
+#bellman_ford and compare_tables by routing table size, and a resend round by number of outstanding acks
+#time per unit (byte, fragment, destination, outstanding ack) shows how a hot path scales with the size
+#every case is measured in --repeats passes and its best pass counts, the results are saved as JSON and compared to
+#a baseline: a case fails when it is slower than threshold times its baseline, or than its spread (worst pass over
+#best pass, in this run or when the baseline was saved) times the baseline when that is larger
+#usage: python benchmarks/bench_hotpaths.py [--save FILE] [--baseline FILE] [--threshold X] [--repeats N] [--only NAME]
+
+import gc
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import cchat
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+#seq is the 16 bit offset of the fragment end, messages stay below 64 KiB
+message_lengths = [80, 800, 8000, 64000]
+fragment_counts = [1, 10, 100, 800]
+table_sizes = [10, 100, 1000, 10000]
+outstanding_acks = [10, 100, 1000, 10000]
+
+own_id = bytes(8)
+other_id = (1).to_bytes(8, byteorder='big')
+
+#best mean time in microseconds of one call of function, repeated for at least min_time seconds, of rounds rounds
+#the garbage collector is off while it runs (as in timeit), a collection in one round and not in another is
+#most of the difference between runs otherwise
+def measure(function, min_time=0.05, rounds=5):
+    best = None
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in range(rounds):
+            repeat = 0
+            start = time.perf_counter()
+            while True:
+                function()
+                repeat += 1
+                elapsed = time.perf_counter() - start
+                if elapsed >= min_time:
+                    break
+            if best == None or elapsed / repeat < best:
+                best = elapsed / repeat
+    finally:
+        if enabled:
+            gc.enable()
+    return best * 1000000
+
+#node wired like main() does, without a socket, nothing is sent
+def build_node():
+    send_receive = cchat.SendAndReceive(("localhost", 5000), own_id, "bench")
+    routing_manager = cchat.RoutingManager(send_receive, own_id)
+    packet_manager = cchat.PacketManager(routing_manager, own_id, "bench")
+    routing_manager.set_packet_manager(packet_manager)
+    send_receive.set_routing_manager(routing_manager)
+    send_receive.set_packet_manager(packet_manager)
+    return (send_receive, routing_manager, packet_manager)
+
+def message(length):
+    return cchat.PacketCollection(0x06, own_id, other_id, 1, bytes(random.getrandbits(8) for i in range(length)))
+
+#all fragments of a message of length bytes
+def bench_encode(length):
+    packets = message(length).get_packets()
+    def run():
+        for packet in packets:
+            packet.encode()
+    return measure(run)
+
+def bench_decode(length):
+    datagrams = [packet.encode() for packet in message(length).get_packets()]
+    def run():
+        for datagram in datagrams:
+            cchat.Packet.init_with_data(datagram)
+    return measure(run)
+
+def bench_split(length):
+    collection = message(length)
+    return measure(collection.get_packets)
+
+#the fragments of a message received in random order, through PacketManager.add and Reassembly, the message is
+#a keepalive so that nothing is printed when it is complete
+def bench_reassembly(fragments):
+    (send_receive, routing_manager, packet_manager) = build_node()
+    collection = cchat.PacketCollection(0x00, other_id, own_id, 1, bytes(fragments * cchat.payload_limit))
+    packets = collection.get_packets()
+    random.shuffle(packets)
+    def run():
+        for packet in packets:
+            packet_manager.add(packet)
+    return measure(run)
+
+#routing table of the given size learned from 8 neighbours, as in bench_routing
+def build_routing(destinations):
+    (send_receive, routing_manager, packet_manager) = build_node()
+    neighbour_ids = [i.to_bytes(8, byteorder='big') for i in range(1, 9)]
+    destination_ids = [random.getrandbits(64).to_bytes(8, byteorder='big') for i in range(destinations)]
+    for neighbour in neighbour_ids:
+        routing_manager.add_neighbour(("localhost", 5000), neighbour)
+    for destination in destination_ids:
+        for neighbour in neighbour_ids:
+            routing_manager.routingTable.set(destination, neighbour, random.randint(1, 6))
+    routing_manager.bellman_ford()
+    return (send_receive, routing_manager, packet_manager, neighbour_ids, destination_ids)
+
+def bench_bellman_ford(destinations):
+    routing_manager = build_routing(destinations)[1]
+    return measure(routing_manager.bellman_ford, min_time=0.2, rounds=1 if destinations >= 1000 else 3)
+
+#a full table from one neighbour, every other call 10 of its hop counts change
+def bench_compare_tables(destinations):
+    (send_receive, routing_manager, packet_manager, neighbour_ids, destination_ids) = build_routing(destinations)
+    neighbour = neighbour_ids[0]
+    tables = []
+    for change in (0, 1):
+        table = [{"DESTINATIONID": destination, "NEXTHOPID": neighbour, \
+            "HOPCOUNT": routing_manager.routingTable.get(destination, neighbour)} for destination in destination_ids]
+        for row in table[:10]:
+            row["HOPCOUNT"] += change
+        tables.append(table)
+    calls = [0]
+    def run():
+        calls[0] += 1
+        routing_manager.compare_tables(tables[calls[0] % 2])
+        send_receive.send_buffer.clear()
+    return measure(run, min_time=0.2, rounds=3)
+
+#one due packet is resent while count packets wait for their ack
+def bench_resend(count):
+    (send_receive, routing_manager, packet_manager) = build_node()
+    routing_manager.add_neighbour(("localhost", 5001), other_id)
+    send_receive.send_buffer.clear()
+    far = send_receive.now() + 3600000
+    for i in range(count):
+        packet = cchat.Packet(0x06, 0x01, own_id, other_id, (i // 800) % 256, (i % 800 + 1) * 80, bytes(80))
+        packet_info = (other_id, packet.session_id, packet.seq)
+        send_receive.add_ack_info(packet_info, packet, 0)
+        send_receive.resend_timers.push(packet_info, far)
+    due = (other_id, 0, 80)
+    def run():
+        send_receive.resend_timers.push(due, 0)
+        send_receive.check_resend()
+        send_receive.send_buffer.clear()
+    return measure(run)
+
+cases = [
+    ("encode", "message bytes", message_lengths, bench_encode),
+    ("decode", "message bytes", message_lengths, bench_decode),
+    ("split_packets", "message bytes", message_lengths, bench_split),
+    ("reassembly", "fragments", fragment_counts, bench_reassembly),
+    ("bellman_ford", "destinations", table_sizes, bench_bellman_ford),
+    ("compare_tables", "destinations", table_sizes, bench_compare_tables),
+    ("resend", "outstanding acks", outstanding_acks, bench_resend),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description="cChat hot path micro-benchmarks")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=default_baseline, help="JSON file to compare to")
+    parser.add_argument("--threshold", type=float, default=1.5, \
+        help="fail when slower than X times the baseline, or than the spread of the passes if it is larger")
+    parser.add_argument("--repeats", type=int, default=5, \
+        help="passes over all cases, the time of a case is its best pass (default 5)")
+    parser.add_argument("--only", help="run only the cases whose name contains this")
+    args = parser.parse_args()
+
+    baseline = {}
+    baseline_spread = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        baseline = saved["results"]
+        baseline_spread = saved.get("spread", {})
+
+    selected = [(name, parameter, size, function) for (name, parameter, sizes, function) in cases \
+        for size in sizes if args.only == None or args.only in name]
+    #the passes are interleaved, a slow spell of the machine then costs one pass of many cases instead of all
+    #passes of one case
+    times = {}
+    for i in range(args.repeats):
+        for (name, parameter, size, function) in selected:
+            random.seed(size)
+            #the routing manager prints every route change
+            with contextlib.redirect_stdout(io.StringIO()):
+                times.setdefault("{}/{}".format(name, size), []).append(function(size))
+
+    results = {}
+    spread = {}
+    regressions = []
+    print("{: >18} {: >17} {: >8} {: >14} {: >14} {: >14} {: >7} {: >7}".format("case", "parameter", "size", \
+        "time (us)", "per unit (us)", "baseline (us)", "ratio", "spread"))
+    for (name, parameter, size, function) in selected:
+        key = "{}/{}".format(name, size)
+        result = min(times[key])
+        results[key] = round(result, 3)
+        #best to worst pass, how much the time of the case varies from run to run on this machine
+        spread[key] = round(max(times[key]) / result, 3)
+        status = ""
+        ratio = ""
+        if key in baseline:
+            ratio = "{:.2f}".format(result / baseline[key])
+            if result > baseline[key] * max(args.threshold, spread[key], baseline_spread.get(key, 1)):
+                status = "SLOWER"
+                regressions.append(key)
+        print("{: >18} {: >17} {: >8} {: >14.2f} {: >14.4f} {: >14} {: >7} {: >7.2f} {}".format(name, parameter, \
+            size, result, result / size, "{:.2f}".format(baseline[key]) if key in baseline else "-", ratio, \
+            spread[key], status))
+
+    if args.save != None:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "repeats": args.repeats, \
+                "results": results, "spread": spread}, f, indent=1, sort_keys=True)
+            f.write("\n")
+    if len(regressions) > 0:
+        print(len(regressions), "case(s) slower than", args.threshold, \
+            "times the baseline (or the spread of the passes):", ", ".join(regressions))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+#route table transfer benchmark, bytes and datagrams of a full route update in the legacy format (10 bytes per
+#route), as a compact route table, and as a compact delta with a few changed routes
+#usage: python benchmarks/bench_route_table.py [destinations ...]
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import cchat
+
+changes = 10
+
+def datagrams(data):
+    return len(cchat.RouteUpdateMessage(True, bytes(8), bytes(8), 1, data).get_packets())
+
+def run(destinations):
+    random.seed(destinations)
+    routes = [(random.getrandbits(64).to_bytes(8, byteorder='big'), random.randint(1, 8)) for i in range(destinations)]
+    legacy = cchat.RouteUpdateMessage(True, bytes(8), bytes(8), 1, routes).data
+    start = time.perf_counter()
+    compact = cchat.encode_route_table(1, 2, None, routes)
+    encode = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    cchat.decode_route_table(compact)
+    decode = (time.perf_counter() - start) * 1000
+    delta = cchat.encode_route_table(1, 3, 2, random.sample(routes, min(changes, destinations)))
+    return ((len(legacy), datagrams(legacy)), (len(compact), datagrams(compact)), (len(delta), datagrams(delta)), \
+        encode, decode)
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [10, 100, 1000, 5000]
+    print("{: >12} {: >18} {: >18} {: >18} {: >11} {: >11}".format("destinations", "legacy (B/pkts)", \
+        "compact (B/pkts)", "delta (B/pkts)", "encode (ms)", "decode (ms)"))
+    for destinations in sizes:
+        (legacy, compact, delta, encode, decode) = run(destinations)
+        print("{: >12} {: >18} {: >18} {: >18} {: >11.2f} {: >11.2f}".format(destinations, "%d/%d" % legacy, \
+            "%d/%d" % compact, "%d/%d" % delta, encode, decode))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#routing benchmark, time of a single route change with the incremental update (update_route)
+#compared to a full recompute (bellman_ford), for 10 to 10000 destinations learned from 8 neighbours
+#usage: python benchmarks/bench_routing.py [destinations ...]
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import cchat
+
+neighbours = 8
+own_id = bytes(8)
+
+#routing manager with a routing table of the given size, every neighbour advertises every destination
+def build(destinations):
+    random.seed(destinations)
+    routing_manager = cchat.RoutingManager(None, own_id)
+    table = routing_manager.routingTable
+    neighbour_ids = [i.to_bytes(8, byteorder='big') for i in range(1, neighbours + 1)]
+    destination_ids = [random.getrandbits(64).to_bytes(8, byteorder='big') for i in range(destinations)]
+    for neighbour in neighbour_ids:
+        table.set(neighbour, own_id, 1)
+    for destination in destination_ids:
+        for neighbour in neighbour_ids:
+            table.set(destination, neighbour, random.randint(1, 6))
+    routing_manager.bellman_ford()
+    return (routing_manager, neighbour_ids, destination_ids)
+
+#mean time in microseconds of one call of function
+def measure(function, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1000000
+
+def run(destinations):
+    (routing_manager, neighbour_ids, destination_ids) = build(destinations)
+
+    def route_change():
+        routing_manager.update_route(random.choice(destination_ids), random.choice(neighbour_ids), \
+            random.randint(1, 6))
+
+    incremental = measure(route_change, 2000)
+    full = measure(routing_manager.bellman_ford, 3 if destinations >= 1000 else 20)
+    return (incremental, full)
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [10, 100, 1000, 10000]
+    print("{: >12} {: >18} {: >18} {: >10}".format("destinations", "update_route (us)", "bellman_ford (us)", "speedup"))
+    for destinations in sizes:
+        (incremental, full) = run(destinations)
+        print("{: >12} {: >18.1f} {: >18.1f} {: >10.0f}".format(destinations, incremental, full, full / incremental))
+
+if __name__ == "__main__":
+    main()
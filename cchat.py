@@ -10,35 +10,84 @@ Send keepalive to the server with this ID as DSTID, it will respond ACK.
 
 """
 
+import os
 import sys
+import asyncio
 import socket
-import select
 import time
 import json
 import threading
-import traceback
 import random
+import heapq
+import collections
+import struct
+import zlib
+import bisect
+import queue
+import logging
+import logging.handlers
 
 packet_header_length = 20
+#datagram limit of peers that did not announce one (older nodes), every node takes datagrams this big
 packet_limit = 100
 payload_limit = packet_limit - packet_header_length
-debug = 0
+#largest datagram a node takes by default (--mtu), announced in SendIdentityMessage, the limit of a link
+#is the smaller of the two ends, and messages are split at the source for the whole path (relays never split)
+max_packet_limit = 1400
+#largest UDP payload
+udp_limit = 65507
+#longest time (ms) between two sends of a fragment that is not acked, the largest resend timeout
+max_resend_interval = 60000
+#protocol extensions this node supports, announced to peers in SendIdentityMessage
+capabilities = ["sack", "compact-routes", "wide-sessions"]
+
+#loggers of the subsystems, a record is formatted only when its level is enabled, and is written to the
+#terminal by a background thread (start_logging), levels are set with --log, /log, /debugon and /debugoff
+log_packet = logging.getLogger("cchat.packet") # messages received and sent (PacketManager)
+log_routing = logging.getLogger("cchat.routing") # forwarding, neighbours and routes (RoutingManager)
+log_transport = logging.getLogger("cchat.transport") # datagrams, resends and socket errors (SendAndReceive)
+subsystems = {"packet": log_packet, "routing": log_routing, "transport": log_transport}
+log_levels = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING, "off": logging.CRITICAL + 1}
+for logger in subsystems.values():
+    logger.setLevel(logging.INFO)
+#without start_logging (the simulator and benchmarks import the module) records go nowhere
+logging.getLogger("cchat").addHandler(logging.NullHandler())
+log_handler = None
+log_listener = None
+
+#packet header: version, type and flags byte, source, destination, session_id, seq
+packet_header = struct.Struct(">B8s8sBH")
+#version 1 header, for peers with "wide-sessions": the same with a 16 bit session_id, the session ids 256 and up
+#are sent with it
+packet_header_wide = struct.Struct(">B8s8sHH")
+
+#header length of the packets of a session
+def header_length(session_id):
+    return packet_header_length if session_id <= 0xFF else packet_header_wide.size
+
+#compact route table ("compact-routes"): format byte, flags, table epoch and version, then for a delta the
+#base version as varint, then the (optionally zlib compressed) entries: count, and per entry sorted by id the
+#id difference to the previous id and hop count + 1 (0 for unreachable) as varints
+#its length is never a multiple of 10, so it cannot be mistaken for the legacy 10 bytes per route format
+route_table_format = 0xFE
+route_table_header = struct.Struct(">BBII")
+route_table_compressed = 0x01
+route_table_delta = 0x02
+#entries are compressed from this many bytes up
+route_table_compress_min = 160
+#full route update request of a node that reads compact route tables: format byte, and the epoch and
+#version of the table we have if any
+route_table_known = struct.Struct(">BII")
 
 #main packet class, can convert data to packet and vice versa
 class Packet:
-    packet_version = 0
-    packet_type = 0
-    packet_flags = 0
-    session_id = 0
-    seq = 0
-    source = bytes()
-    destination = bytes()
-    data = bytes()
+    __slots__ = ("packet_version", "packet_type", "packet_flags", "session_id", "seq", "source", "destination", "data")
 
     # packet_type is byte
     # seq,total int
-    # data bytes
+    # data bytes or memoryview
     def __init__(self, packet_type, packet_flags, source, destination, session_id, seq, data):
+        self.packet_version = 0
         self.packet_type = packet_type
         self.packet_flags = packet_flags
         self.session_id = session_id
@@ -47,36 +96,44 @@ class Packet:
         self.destination = destination
         self.data = data
 
-    # init packet fields with data (bytes)
+    # init packet fields with data (bytes), the payload is a memoryview into data, not a copy
     @classmethod
     def init_with_data(self, data):
         # parse the data
-        # print("packet length:",len(data))
         if (len(data) >= packet_header_length):
-            first_byte = int.from_bytes(data[0:1], byteorder='big')
-            packet_version = ((first_byte & 0xC0) >> 6)
-            packet_type = ((first_byte & 0x38) >> 3)
-            packet_flags = first_byte & 0x07
-            session_id = int.from_bytes(data[17:18], byteorder='big')
-            seq = int.from_bytes(data[18:20], byteorder='big')
-            source = data[1:9]
-            destination = data[9:17]
-            length = int.from_bytes(data[9:10], byteorder='big')
-            payload = data[20:]
-            return Packet(packet_type, packet_flags, source, destination, session_id, seq, payload)
+            if data[0] < 0x40:
+                header = packet_header
+            elif data[0] < 0x80 and len(data) >= packet_header_wide.size:
+                header = packet_header_wide
+            else:
+                raise Exception("cannot parse packet, unknown version or too short:", data[0] >> 6, len(data))
+            (first_byte, source, destination, session_id, seq) = header.unpack_from(data)
+            packet = Packet((first_byte & 0x38) >> 3, first_byte & 0x07, source, destination, session_id, seq, \
+                memoryview(data)[header.size:])
+            packet.packet_version = (first_byte & 0xC0) >> 6
+            return packet
         else:
             raise Exception("cannot parse packet, as it is too short:", len(data))
 
+    #encode packet fields into buffer (bytearray, big enough for the packet), returns the packet length
+    #session ids that do not fit a byte take the version 1 header
+    def encode_into(self, buffer):
+        if self.session_id <= 0xFF:
+            header = packet_header
+            version = 0
+        else:
+            header = packet_header_wide
+            version = 1
+        header.pack_into(buffer, 0, (version << 6) | (self.packet_type << 3) | self.packet_flags, \
+            self.source, self.destination, self.session_id, self.seq)
+        length = header.size + len(self.data)
+        buffer[header.size:length] = self.data
+        return length
+
     #encode packet fields to data
     def encode(self):
-        b = bytearray()
-        b.append((self.packet_version << 6) | (self.packet_type << 3) | self.packet_flags)
-        b.extend(self.source)
-        b.extend(self.destination)
-        b.extend(self.session_id.to_bytes(1, byteorder='big'))
-        b.extend(self.seq.to_bytes(2, byteorder='big'))
-        b.extend(self.data)
-
+        b = bytearray(header_length(self.session_id) + len(self.data))
+        self.encode_into(b)
         return bytes(b)
 
     #get ack packet out of standard packet
@@ -99,11 +156,7 @@ class Packet:
 #there are methods to get a list of packets and also to get a certain message (like ScreenMessage) 
 #from list of packets
 class PacketCollection:
-    session_id = 0
-    packet_type = 0
-    source = bytes()
-    destination = bytes()
-    data = bytes()
+    __slots__ = ("session_id", "packet_type", "source", "destination", "data")
 
     def __init__(self, packet_type, source, destination, session_id, data):
         self.session_id = session_id
@@ -116,60 +169,27 @@ class PacketCollection:
     @classmethod
     def init_with_packets(self, packets):
         # assemble the packets into one message
-        first_single = self.find_packet_with_flags(self, 0x03, packets)
-        first_packet = self.find_packet_with_flags(self, 0x01, packets)
-        last_packet = self.find_packet_with_flags(self, 0x02, packets)
-        if (first_single != None):
-            return PacketCollection(first_single.packet_type, first_single.source, first_single.destination,
-                                    first_single.session_id, first_single.data)
-        elif (first_packet != None and last_packet != None):
-            # find if middle packets are there
-            next_packet = first_packet
-            total_seq = last_packet.seq
-            cur_seq = next_packet.seq
-            packetdata = bytearray()
-            while (cur_seq < total_seq and next_packet != None):
-                # print("cur_seq:",cur_seq)
-                # print("total_seq:",total_seq)
-                cur_seq = next_packet.seq
-                packetdata.extend(next_packet.data)
-                next_packet = self.find_next_packet(self, cur_seq, packets)
-
-            if (cur_seq == total_seq):
-                # we have all the packets!
-                return PacketCollection(first_packet.packet_type, first_packet.source, first_packet.destination,
-                                        first_packet.session_id, bytes(packetdata))
-            else:
-                raise Exception("not all packets are available!")
-        else:
-            raise Exception("not all packets are available!")
-
-    def find_next_packet(self, seq, packets):
-        # find packet with certain flags
-        returnValue = None
+        reassembly = None
         for packet in packets:
-            if ((packet.packet_flags == 0x00 or packet.packet_flags == 0x02) and len(packet.data) + seq == packet.seq):
-                returnValue = packet
-                break
-        return returnValue
-
-    def find_packet_with_flags(self, flags, packets):
-        # find packet with certain flags
-        returnValue = None
-        for packet in packets:
-            if (packet.packet_flags == flags):
-                returnValue = packet
-                break
-        return returnValue
+            if packet.packet_flags == 0x03:
+                return PacketCollection(packet.packet_type, packet.source, packet.destination,
+                                        packet.session_id, bytes(packet.data))
+            if reassembly == None:
+                reassembly = Reassembly(packet)
+            reassembly.add(packet)
+        if reassembly != None and reassembly.is_complete():
+            return reassembly.get_packet_collection()
+        raise Exception("not all packets are available!")
 
     #generate a list of packets, based on data. The data can be longer so it will automatically
-    #get certain number of packets
-    def split_packets(self, packet_type, source, destination, session_id, data):
+    #get certain number of packets, with at most payload_limit bytes of data each
+    def split_packets(self, packet_type, source, destination, session_id, data, payload_limit=payload_limit):
         packets = []
 
-        # check for length of data, split to data segments
+        # check for length of data, split to data segments (views into data, not copies)
         data_segments = []
         packet_no = 1
+        data = memoryview(data)
 
         while (packet_no * payload_limit < len(data)):
             data_segments.append(data[(packet_no - 1) * payload_limit:packet_no * payload_limit])
@@ -196,8 +216,9 @@ class PacketCollection:
         return packets
 
     #get a list of packets
-    def get_packets(self):
-        return self.split_packets(self.packet_type, self.source, self.destination, self.session_id, self.data)
+    def get_packets(self, payload_limit=payload_limit):
+        return self.split_packets(self.packet_type, self.source, self.destination, self.session_id, self.data, \
+            payload_limit)
 
     #get a certain message
     def get_collection(self):
@@ -206,31 +227,159 @@ class PacketCollection:
         if (self.packet_type == 0x01):
             return RouteUpdateMessage(False, self.source, self.destination, self.session_id, self.data)
         if (self.packet_type == 0x02):
-            return RequestFullRouteUpdateMessage(self.source, self.destination, self.session_id)
+            return RequestFullRouteUpdateMessage(self.source, self.destination, self.session_id, self.data)
         if (self.packet_type == 0x03):
             return RouteUpdateMessage(True, self.source, self.destination, self.session_id, self.data)
         if (self.packet_type == 0x04):
             return SendIdentityMessage(self.source, self.destination, self.session_id, self.data)
         # if (self.packet_type==0x05):
         #    return GroupMessage(self.source, self.destination, self.session_id, self.data)
+        if (self.packet_type == 0x05):
+            return LinkStateMessage(self.source, self.destination, self.session_id, self.data)
         if (self.packet_type == 0x06):
             return ScreenMessage(self.source, self.destination, self.session_id, self.data)
         if (self.packet_type == 0x07):
             return BinaryMessage(self.source, self.destination, self.session_id, self.data)
 
+#fragments of one incoming message. The source sends them all of one size (the last one shorter) at multiples of
+#it, and relays do not split them, so a fragment that does not fit that grid is not of the message and is
+#dropped. Fragments cannot overlap, the message is complete when they have as many bytes as it
+class Reassembly:
+
+    def __init__(self, packet):
+        self.packet_type = packet.packet_type
+        self.source = packet.source
+        self.destination = packet.destination
+        self.session_id = packet.session_id
+        self.size = None # fragment size of the source, from the first fragment that is not the last one
+        self.fragments = {} # start offset = data
+        self.received = 0
+        self.updated = 0
+        self.total = None
+
+    #add a fragment, returns the number of bytes stored, 0 for a duplicate or a fragment that does not fit
+    def add(self, packet):
+        seq = packet.seq
+        length = len(packet.data)
+        start = seq - length
+        if length == 0 or start < 0 or start in self.fragments:
+            return 0
+        if packet.packet_flags == 0x02:
+            if self.total != None or \
+                (self.size != None and (start % self.size != 0 or length > self.size)) or \
+                any([offset > start for offset in self.fragments]):
+                return 0
+            self.total = seq
+        else:
+            if self.size == None:
+                #the last fragment, if it came first, has to be on the grid of this size
+                if self.total != None and ((self.total - self.received) % length != 0 or self.received > length):
+                    return 0
+                self.size = length
+            if length != self.size or start % self.size != 0 or (self.total != None and seq >= self.total):
+                return 0
+        self.fragments[start] = bytes(packet.data)
+        self.received += length
+        return length
+
+    def is_complete(self):
+        return self.total != None and self.received == self.total
+
+    #join the fragments in offset order
+    def get_packet_collection(self):
+        return PacketCollection(self.packet_type, self.source, self.destination, self.session_id, \
+            b"".join([self.fragments[start] for start in sorted(self.fragments)]))
+
 class KeepaliveMessage(PacketCollection):
+    __slots__ = ()
 
     def __init__(self, source, destination, session_id):
         super().__init__(0x00, source, destination, session_id, bytes())
 
 
-class RouteUpdateMessage(PacketCollection):
+def encode_varint(value, buffer):
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+#returns (value, offset after the varint)
+def decode_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return (value, offset)
+        shift += 7
+
+#routes [(destination, hopcount)] of table version (epoch, version) as a compact route table,
+#with base as the version the routes are the changes since (None for the whole table)
+def encode_route_table(epoch, version, base, routes):
+    entries = bytearray()
+    encode_varint(len(routes), entries)
+    previous = 0
+    for (destination, hopcount) in sorted(routes):
+        longid = int.from_bytes(destination, byteorder='big')
+        encode_varint(longid - previous, entries)
+        encode_varint(0 if hopcount == 0xFFFF else hopcount + 1, entries)
+        previous = longid
+    flags = 0
+    if len(entries) >= route_table_compress_min:
+        compressed = zlib.compress(bytes(entries))
+        if len(compressed) < len(entries):
+            (entries, flags) = (compressed, route_table_compressed)
+    if base != None:
+        flags |= route_table_delta
+    data = bytearray(route_table_header.pack(route_table_format, flags, epoch, version))
+    if base != None:
+        encode_varint(base, data)
+    data.extend(entries)
+    if len(data) % 10 == 0:
+        data.append(0)
+    return bytes(data)
+
+def is_route_table(data):
+    return len(data) % 10 != 0 and len(data) >= route_table_header.size and data[0] == route_table_format
+
+#returns ((epoch, version, base), routes), base is None for the whole table
+def decode_route_table(data):
+    (format, flags, epoch, version) = route_table_header.unpack_from(data)
+    offset = route_table_header.size
+    base = None
+    if flags & route_table_delta:
+        (base, offset) = decode_varint(data, offset)
+    entries = data[offset:]
+    if flags & route_table_compressed:
+        #decompressobj leaves the padding byte in unused_data
+        entries = zlib.decompressobj().decompress(entries)
+    (count, offset) = decode_varint(entries, 0)
     routes = []
+    longid = 0
+    for i in range(count):
+        (difference, offset) = decode_varint(entries, offset)
+        (hopcount, offset) = decode_varint(entries, offset)
+        longid += difference
+        routes.append((longid.to_bytes(8, byteorder='big'), 0xFFFF if hopcount == 0 else hopcount - 1))
+    return ((epoch, version, base), routes)
 
+
+class RouteUpdateMessage(PacketCollection):
+    __slots__ = ("routes", "table_version")
+
+    # table_version is (epoch, version, base) for a compact route table, None for the legacy format
     def __init__(self, isFull, source, destination, session_id, route_data):
+        self.table_version = None
+
+        if (type(route_data) is bytes and is_route_table(route_data)):
+            (self.table_version, self.routes) = decode_route_table(route_data)
+            super().__init__((0x03 if isFull else 0x01), source, destination, session_id, route_data)
 
-        if (type(route_data) is bytes):
-            no_routes = len(route_data) % 10
+        elif (type(route_data) is bytes):
+            self.routes = []
+            no_routes = len(route_data) // 10
             for i in range(no_routes):
                 self.routes.append((route_data[i * 10:i * 10 + 8], int.from_bytes(route_data[i * 10 + 8:i * 10 + 10])))
             super().__init__((0x03 if isFull else 0x01), source, destination, session_id, route_data)
@@ -249,36 +398,89 @@ class RouteUpdateMessage(PacketCollection):
 
 
 class RequestFullRouteUpdateMessage(PacketCollection):
+    __slots__ = ("compact", "known_version")
+
+    # compact is set when the sender reads compact route tables, known_version is the (epoch, version) of the
+    # table we have from the destination, only changes since it are needed
+    def __init__(self, source, destination, session_id, known_version=None):
+        if (type(known_version) is bytes):
+            data = known_version
+            self.compact = len(data) > 0 and data[0] == route_table_format
+            self.known_version = None
+            if self.compact and len(data) == route_table_known.size:
+                self.known_version = route_table_known.unpack(data)[1:]
+        else:
+            self.compact = True
+            self.known_version = known_version
+            data = bytes([route_table_format])
+            if known_version != None:
+                data = route_table_known.pack(route_table_format, known_version[0], known_version[1])
+        super().__init__(0x02, source, destination, session_id, data)
+
+
+#link state advertisement of origin, flooded hop by hop to all nodes
+#data: origin (8 bytes), sequence number (4 bytes), then neighbour (8 bytes) and cost (2 bytes) for each link
+class LinkStateMessage(PacketCollection):
+    __slots__ = ("origin", "lsa_seq", "links")
+
+    def __init__(self, source, destination, session_id, lsa_data):
+
+        if (type(lsa_data) is bytes):
+            if len(lsa_data) < 12:
+                raise Exception("link state advertisement is too short:", len(lsa_data))
+            self.origin = lsa_data[0:8]
+            self.lsa_seq = int.from_bytes(lsa_data[8:12], byteorder='big')
+            self.links = {}
+            for i in range(12, len(lsa_data) - 9, 10):
+                self.links[lsa_data[i:i + 8]] = int.from_bytes(lsa_data[i + 8:i + 10], byteorder='big')
+            super().__init__(0x05, source, destination, session_id, lsa_data)
+
+        elif (type(lsa_data) is tuple):
+            # (origin, seq, {neighbour: cost})
+            (self.origin, self.lsa_seq, self.links) = lsa_data
+            data = bytearray(self.origin)
+            data.extend(self.lsa_seq.to_bytes(4, byteorder='big'))
+            for (neighbour, cost) in self.links.items():
+                data.extend(neighbour)
+                data.extend(cost.to_bytes(2, byteorder='big'))
+            super().__init__(0x05, source, destination, session_id, bytes(data))
 
-    def __init__(self, source, destination, session_id):
-        super().__init__(0x02, source, destination, session_id, bytes())
+        else:
+            raise Exception("for link state data should be (origin, seq, {neighbour: cost}) or bytes()")
 
 
 class SendIdentityMessage(PacketCollection):
-    nickname = ""
+    __slots__ = ("nickname", "capabilities", "mtu")
 
-    def __init__(self, source, destination, session_id, nickname_data):
+    #mtu is the largest datagram the source takes
+    def __init__(self, source, destination, session_id, nickname_data, mtu=packet_limit):
 
         # print("SendIdentityMessage: source:"+print_hex(source)+" destination:"+print_hex(destination)+" nickname data:"+print_hex(nickname_data))
 
         if (type(nickname_data) is str):
             self.nickname = nickname_data
+            self.capabilities = capabilities
+            self.mtu = mtu
             json_string = "{\"ID\" : \"" + print_hex(
-                source) + "\", \"responseRequired\" : \"true\", \"name\" : \"" + nickname_data + "\"}"
+                source) + "\", \"responseRequired\" : \"true\", \"name\" : \"" + nickname_data + \
+                "\", \"capabilities\" : " + json.dumps(capabilities) + ", \"mtu\" : " + str(mtu) + "}"
             super().__init__(0x04, source, destination, session_id, json_string.encode())
         elif (type(nickname_data) is bytes):
             json_string = nickname_data.decode("utf-8")
-            if debug == 1:
-                print("parsing json:" + json_string)
+            log_packet.debug("parsing json: %s", json_string)
             json_dict = json.loads(json_string)
             self.nickname = json_dict["name"]
+            #older nodes do not send capabilities
+            self.capabilities = json_dict.get("capabilities", [])
+            #or an mtu, they take packet_limit
+            self.mtu = min(max(int(json_dict.get("mtu", packet_limit)), packet_limit), udp_limit)
             super().__init__(0x04, source, destination, session_id, nickname_data)
         else:
             raise Exception("nickname_data must be type string or bytes()")
 
 
 class ScreenMessage(PacketCollection):
-    message = ""
+    __slots__ = ("message",)
 
     def __init__(self, source, destination, session_id, message_data):
 
@@ -293,6 +495,7 @@ class ScreenMessage(PacketCollection):
 
 
 class BinaryMessage(PacketCollection):
+    __slots__ = ()
 
     def __init__(self, source, destination, session_id, message_data):
 
@@ -305,109 +508,202 @@ class BinaryMessage(PacketCollection):
 #it also handles the session_id for different destinations.
 class PacketManager:
     routing_manager=None
-    #destination openSessions
-    receive_sessions={}
-    #destination session_id
-    send_sessions={}
+    #incomplete messages are dropped after reassembly_ttl ms without a new fragment. A fragment that is missing
+    #is not acked, its sender resends it at least every max_resend_interval ms, so a message that gets no fragment
+    #in twice that has lost its sender (or the fragments are late copies of a completed message).
+    #A fragment of a new message is refused (not acked, the sender resends it) while its source has more than
+    #reassembly_peer_bytes or all peers more than reassembly_total_bytes in incomplete messages
+    reassembly_ttl=2 * max_resend_interval
+    reassembly_peer_bytes=256 * 1024
+    reassembly_total_bytes=4 * 1024 * 1024
+    #session id of keepalives, get_send_session_id does not give it out
+    keepalive_session_id=0
     nickname="default"
     longid=bytes()
-    keepalive_stop=False
-    keepalive_interval=10
-    destlist=set()
 
     def __init__(self,routing_manager,longid,nickname):
         self.routing_manager=routing_manager 
+        self.send_receive=routing_manager.send_receive
         self.nickname=nickname
         self.longid=longid
-        #start keepalive thread
-        thread = threading.Thread(target=self.thread_function_send_keepalive)   
-        thread.start()
-        # thread.join()
+        #(source, session_id) = Reassembly of incomplete messages, least recently used first
+        self.receive_sessions=collections.OrderedDict()
+        self.reassembly_bytes=0
+        self.reassembly_peer_usage={} # source = bytes in receive_sessions
+        self.reassembly_counters={"expired": 0, "refused": 0, "duplicate": 0}
+        self.reassembly_timer=None
+        #(source, session_id) of messages of more than one fragment completed lately = end of their time wait
+        self.completed_sessions=TimerHeap()
+        #destination session_id
+        self.send_sessions={}
+        self.destlist=set()
+        #source capabilities, from SendIdentityMessage
+        self.peer_capabilities={}
+        #source = largest datagram it takes, from SendIdentityMessage
+        self.peer_mtus={}
+        #(distance_table, all nodes in it support wide session ids), checked again when the link state routing
+        #gives a new distance_table or a capability changes
+        self.wide_sessions_nodes=(None, False)
+        #(table_version, smallest mtu of the nodes we have a route to), checked again when the routes or an
+        #mtu change
+        self.path_mtu_nodes=(None, packet_limit)
+        #called with (source, message) for every ScreenMessage received, if set (the simulator uses it)
+        self.on_screen_message=None
 
     #incoming packets are sent here
     def add(self, packet):
 
-        # session_id packetlist
-        open_sessions = {}
-        if packet.destination in self.receive_sessions:
-            open_sessions = self.receive_sessions[packet.destination]
-        else:
-            self.receive_sessions[packet.destination] = open_sessions
-
-        packet_list = []
-        if packet.session_id in open_sessions:
-            packet_list = open_sessions[packet.session_id]
-        else:
-            open_sessions[packet.session_id] = packet_list
-
-        # add packet to the list
-        packet_list.append(packet)
-
-        # verify if session is complete
-        is_complete = False
-        packet_collection = None
-        try:
-            packet_collection = PacketCollection.init_with_packets(packet_list).get_collection()
+        if packet.packet_flags == 0x03:
+            # single packet message, no reassembly needed
+            packet_collection = PacketCollection(packet.packet_type, packet.source, packet.destination, \
+                packet.session_id, bytes(packet.data)).get_collection()
             is_complete = True
-            del open_sessions[packet.session_id]
-
-        except Exception as error:
-            print(error)
-            is_complete = False
-            if (str(error) != "not all packets are available!"):
-                raise error
+        else:
+            session = (packet.source, packet.session_id)
+            reassembly = self.receive_sessions.get(session)
+            if reassembly == None:
+                reassembly = Reassembly(packet)
+                self.receive_sessions[session] = reassembly
+                self.arm_reassembly_timer()
+            else:
+                self.receive_sessions.move_to_end(session)
+            reassembly.updated = self.send_receive.now()
+            added = reassembly.add(packet)
+            if added != 0:
+                self.reassembly_bytes += added
+                self.reassembly_peer_usage[packet.source] = self.reassembly_peer_usage.get(packet.source, 0) + added
+            is_complete = reassembly.is_complete()
+            if is_complete:
+                self.remove_reassembly(session)
+                self.completed_sessions.push(session, self.send_receive.now() + self.reassembly_ttl)
+                packet_collection = reassembly.get_packet_collection().get_collection()
 
         # check the completed packetcollection
         #have a logic, based on incoming message type
         if is_complete == True:
             # print("Session complete")
             if type(packet_collection) == KeepaliveMessage:
-                if debug == 1:
-                    print("KeepaliveMessage received from: " + print_hex(packet_collection.source))
+                if log_packet.isEnabledFor(logging.DEBUG):
+                    log_packet.debug("KeepaliveMessage received from: %s", print_hex(packet_collection.source))
                 # self.routing_manager.send(KeepaliveMessage(None,\
                 #    packet_collection.source,\
                 #    self.get_send_session_id(packet_collection.source)))
             elif type(packet_collection) == RouteUpdateMessage:
-                for route in packet_collection.routes:
-                    print("route: " + print_hex(route[0]) + " hops:" + str(route[1]))
-                print("RouteUpdateMessage received from: " + print_hex(packet_collection.source) + \
-                      " data:" + print_hex(packet_collection.data))
-                # make the table compatible and compare to our version
-                no_routes = len(packet_collection.data) // 10
+                if log_packet.isEnabledFor(logging.DEBUG):
+                    for route in packet_collection.routes:
+                        log_packet.debug("route: %s hops:%d", print_hex(route[0]), route[1])
+                    log_packet.debug("RouteUpdateMessage received from: %s data:%s", \
+                        print_hex(packet_collection.source), print_hex(packet_collection.data))
+                # make the table compatible and compare to our version, a delta is applied to the
+                # table we have from the source
+                routes = self.routing_manager.merge_neighbour_table(packet_collection.source, \
+                    packet_collection.table_version, packet_collection.routes)
                 routing_table = []
-                for i in range(no_routes):
-                    routing_table.append({"DESTINATIONID": packet_collection.data[i * 10:i * 10 + 8], \
+                for (destination, hopcount) in routes:
+                    routing_table.append({"DESTINATIONID": destination, \
                                           "NEXTHOPID": packet_collection.source, \
-                                          "HOPCOUNT": int.from_bytes(packet_collection.data[i * 10 + 8:i * 10 + 10],\
-                                              byteorder='big')})
-                if len(routing_table)>0:
-                    #compare routing tables
-                    self.routing_manager.compare_tables(routing_table)
+                                          "HOPCOUNT": hopcount})
+                if len(routing_table)>0 or packet_collection.table_version != None:
+                    #compare routing tables, link state nodes only use the empty update of a leaving neighbour
+                    if not self.routing_manager.link_state:
+                        self.routing_manager.compare_tables(routing_table)
                 else:
                     #if route update message is empty, remove all routes via source
                     self.routing_manager.remove_node(packet_collection.source)
 
+            elif type(packet_collection) == LinkStateMessage:
+                if log_packet.isEnabledFor(logging.DEBUG):
+                    log_packet.debug("LinkStateMessage received from: %s origin:%s seq:%d", \
+                        print_hex(packet_collection.source), print_hex(packet_collection.origin), \
+                        packet_collection.lsa_seq)
+                self.routing_manager.receive_link_state(packet_collection.source, packet_collection.origin, \
+                    packet_collection.lsa_seq, packet_collection.links)
             elif type(packet_collection) == RequestFullRouteUpdateMessage:
-                print("RequestFullRouteUpdateMessage received from: " + print_hex(packet_collection.source))
-                # dest hop
-                self.request_send_routing_update(True, \
-                    packet_collection.source, \
-                        self.routing_manager.get_routing_table())
+                if log_packet.isEnabledFor(logging.DEBUG):
+                    log_packet.debug("RequestFullRouteUpdateMessage received from: %s", \
+                        print_hex(packet_collection.source))
+                self.send_routing_table(packet_collection.source, packet_collection.compact, \
+                    packet_collection.known_version)
             elif type(packet_collection) == SendIdentityMessage:
-                print("SendIdentityMessage received from: " + print_hex(packet_collection.source) + \
-                      " nickname:" + packet_collection.nickname)
+                if log_packet.isEnabledFor(logging.INFO):
+                    log_packet.info("SendIdentityMessage received from: %s nickname:%s", \
+                        print_hex(packet_collection.source), packet_collection.nickname)
                 self.destlist.add((packet_collection.source, packet_collection.nickname))
-                if debug == 1:
-                    print("Source and Nickname added to /list")
+                self.peer_capabilities[packet_collection.source] = set(packet_collection.capabilities)
+                self.wide_sessions_nodes = (None, False)
+                self.peer_mtus[packet_collection.source] = packet_collection.mtu
+                self.path_mtu_nodes = (None, packet_limit)
+                self.send_receive.set_link_limit(packet_collection.source, packet_collection.mtu)
+                self.send_receive.limit_send_window(packet_collection.source)
+                log_packet.debug("Source and Nickname added to /list")
             elif type(packet_collection) == ScreenMessage:
                 print("ScreenMessage received from: " + print_hex(packet_collection.source) + \
                       " message: " + packet_collection.message)
+                if self.on_screen_message != None:
+                    self.on_screen_message(packet_collection.source, packet_collection.message)
             elif type(packet_collection) == BinaryMessage:
                 print("BinaryMessage received from:" + print_hex(packet_collection.source) + \
                       "data:" + packet_collection.data)
         else:
-            if debug == 1:
-                print("Session not complete")
+            log_packet.debug("Session not complete")
+
+    def remove_reassembly(self, session):
+        reassembly = self.receive_sessions.pop(session)
+        self.reassembly_bytes -= reassembly.received
+        self.reassembly_peer_usage[session[0]] -= reassembly.received
+        if self.reassembly_peer_usage[session[0]] <= 0:
+            del self.reassembly_peer_usage[session[0]]
+
+    #a fragment of a message completed less than reassembly_ttl ago (after the last late copy of it) is a late
+    #copy, it is acked and not reassembled again. The sender does not give the session id out again before that
+    #(SendAndReceive.close_session)
+    def is_late_copy(self, packet):
+        if packet.packet_flags == 0x03:
+            return False
+        session = (packet.source, packet.session_id)
+        timestamp = self.send_receive.now()
+        self.completed_sessions.pop_due(timestamp)
+        if session not in self.completed_sessions:
+            return False
+        self.completed_sessions.push(session, timestamp + self.reassembly_ttl)
+        self.reassembly_counters["duplicate"] += 1
+        return True
+
+    #called before a fragment for us is acked. Incomplete messages are never evicted, their fragments have
+    #been acked and the sender does not send them again, so fragments of messages being reassembled are always
+    #taken and only a fragment that starts a new message is refused while over the limits
+    def has_room(self, packet):
+        if packet.packet_flags == 0x03 or (packet.source, packet.session_id) in self.receive_sessions:
+            return True
+        if self.reassembly_peer_usage.get(packet.source, 0) + len(packet.data) > self.reassembly_peer_bytes or \
+            self.reassembly_bytes + len(packet.data) > self.reassembly_total_bytes:
+            self.reassembly_counters["refused"] += 1
+            return False
+        return True
+
+    def arm_reassembly_timer(self):
+        if self.reassembly_timer == None and len(self.receive_sessions) > 0:
+            oldest = next(iter(self.receive_sessions.values()))
+            delay = max(oldest.updated + self.reassembly_ttl - self.send_receive.now(), 0) / 1000
+            self.reassembly_timer = self.send_receive.loop.call_later(delay, self.expire_reassembly)
+
+    #drop incomplete messages that have not received a fragment in reassembly_ttl
+    def expire_reassembly(self):
+        self.reassembly_timer = None
+        timestamp = self.send_receive.now()
+        while len(self.receive_sessions) > 0:
+            (session, oldest) = next(iter(self.receive_sessions.items()))
+            if timestamp - oldest.updated < self.reassembly_ttl:
+                break
+            if log_packet.isEnabledFor(logging.DEBUG):
+                log_packet.debug("reassembly expired for source:%s session_id:%d", print_hex(session[0]), session[1])
+            self.remove_reassembly(session)
+            self.reassembly_counters["expired"] += 1
+        self.arm_reassembly_timer()
+
+    #check if a peer has announced support for a protocol extension
+    def has_capability(self, longid, capability):
+        return longid in self.peer_capabilities and capability in self.peer_capabilities[longid]
 
     #print all the destinations with nicknames
     def print_destlist(self):
@@ -425,23 +721,67 @@ class PacketManager:
             print(print_hex(row[0]),row[1])
             #print("{: >20} {: >20}".format(*row))
     
-    #get session id for a particular destination
+    #get session id for a particular destination, 1 to 255, or 256 to 65535 when every node on the way takes
+    #the version 1 header. An id is not given out again while packets of its last message wait for their ack,
+    #nor while it is closed (SendAndReceive.close_session): until then late copies of the last message, their
+    #acks and what the destination reassembled of them can still be around and would mix with a new message.
+    #None when all ids are in use or messages to the destination are already waiting, the message then waits
+    #in SendAndReceive.send for an id
     def get_send_session_id(self, destination):
-        session_id = None
-        if destination in self.send_sessions:
-            session_id = self.send_sessions[destination] + 1
-            if session_id == 256:
-                session_id = 0
+        if destination in self.send_receive.waiting_messages:
+            return None
+        return self.find_send_session_id(destination)
+
+    def find_send_session_id(self, destination):
+        (first, end) = (0x100, 0x10000) if self.use_wide_sessions(destination) else (1, 0x100)
+        session_id = self.send_sessions.get(destination, end - 1)
+        open_sessions = self.send_receive.open_sessions
+        closed_sessions = self.send_receive.closed_sessions
+        closed_sessions.pop_due(self.send_receive.now())
+        for i in range(end - first):
+            session_id = session_id + 1 if first <= session_id < end - 1 else first
+            if (destination, session_id) not in open_sessions and (destination, session_id) not in closed_sessions:
+                break
         else:
-            session_id = 0
+            return None
         self.send_sessions[destination] = session_id
         return session_id
 
+    #wide session ids are used only when every node a packet can pass supports them, a relay that does not
+    #takes the version 1 header for a version 0 one. That is known for a neighbour, and with link state
+    #routing when all nodes in the network have announced "wide-sessions" (packets can take any path, also
+    #the backup next hops), with distance vector routing the path is not known
+    def use_wide_sessions(self, destination):
+        if not self.has_capability(destination, "wide-sessions"):
+            return False
+        if destination in self.routing_manager.neighbors:
+            return True
+        if not self.routing_manager.link_state:
+            return False
+        distance_table = self.routing_manager.distance_table
+        if self.wide_sessions_nodes[0] is not distance_table:
+            self.wide_sessions_nodes = (distance_table, all([self.has_capability(node, "wide-sessions") \
+                for node in distance_table if node != self.longid]))
+        return self.wide_sessions_nodes[1]
+
+    #largest datagram on the way to destination, relays do not split packets. That is the mtu of a neighbour,
+    #and for other destinations the smallest mtu of all nodes we have a route to, as packets can take any path
+    #(the equal cost and backup next hops too). Nodes that did not announce an mtu take packet_limit
+    def get_path_mtu(self, destination):
+        if destination in self.routing_manager.neighbors:
+            return self.peer_mtus.get(destination, packet_limit)
+        version = self.routing_manager.table_version
+        if self.path_mtu_nodes[0] != version:
+            self.path_mtu_nodes = (version, min([self.peer_mtus.get(node, packet_limit) \
+                for node in self.routing_manager.distance_table if node != self.longid], default=packet_limit))
+        return self.path_mtu_nodes[1]
+
     #send a text message, as input from keyboard
     def send_text(self, text):
         if text == "/list":
                 self.print_destlist()
-        elif text[0] == "/" and text not in ('/help','/debugon','/debugoff','/exit'):
+        elif text[0] == "/" and text not in ('/help','/debugon','/debugoff','/exit','/log') and \
+            not text.startswith('/log '):
             #separator for nickname is first space
             givenNick=(text.split(" ", 1))[0][1:]
             destination=None
@@ -460,13 +800,13 @@ class PacketManager:
                 print("ScreenMessage sent to: " + givenNick + " destination: " + print_hex(
                     destination) + " text: " + text[(len(givenNick) + 2):])
                 # send
-                routing_manager.send(m.get_packets(), destination)
+                self.routing_manager.send(m, destination)
         else:
             # send text to all destinations
             for destination in self.routing_manager.get_all_destinations():
                 m = ScreenMessage(self.longid, destination, self.get_send_session_id(destination), text)
                 print("ScreenMessage sent to: " + print_hex(destination) + " text:" + text)
-                routing_manager.send(m.get_packets(), destination)
+                self.routing_manager.send(m, destination)
 
     #send a RouteUpdateMessage
     def request_send_routing_update(self, isFull, destination, routes):
@@ -474,18 +814,38 @@ class PacketManager:
                                 destination, \
                                 self.get_send_session_id(destination), \
                                 routes)
-        self.routing_manager.send(message.get_packets(), destination)
-        print("RouteUpdateMessage sent to: " + print_hex(destination) + " data:" + print_hex(
-            message.data))
+        self.routing_manager.send(message, destination)
+        if log_packet.isEnabledFor(logging.DEBUG):
+            log_packet.debug("RouteUpdateMessage sent to: %s data:%s", print_hex(destination), print_hex(message.data))
+
+    #send a LinkStateMessage with the advertisement (origin, seq, {neighbour: cost})
+    def request_send_link_state(self, destination, advertisement):
+        self.routing_manager.send(LinkStateMessage(self.longid, destination, \
+            self.get_send_session_id(destination), advertisement), destination)
+        if log_packet.isEnabledFor(logging.DEBUG):
+            log_packet.debug("LinkStateMessage sent to: %s origin:%s seq:%d", print_hex(destination), \
+                print_hex(advertisement[0]), advertisement[1])
+
+    #answer a full route update request, in the compact format to peers that support it, only with the
+    #changes since known_version when we still have them
+    def send_routing_table(self, destination, compact, known_version):
+        if compact or self.has_capability(destination, "compact-routes"):
+            (version, routes) = self.routing_manager.get_routing_table_since(destination, known_version)
+            self.request_send_routing_update(True, destination, encode_route_table(*version, routes))
+        else:
+            self.request_send_routing_update(True, destination, self.routing_manager.get_routing_table(destination))
 
-    #send a RequestFullRoutingUpdateMessage
+    #send a RequestFullRoutingUpdateMessage, with the version of the destination's table we have
     def request_send_fullrouting_update(self, destination):
+        table = self.routing_manager.neighbour_tables.get(destination)
         self.routing_manager.send( \
             RequestFullRouteUpdateMessage( \
                 self.longid, \
                 destination, \
-                self.get_send_session_id(destination)).get_packets(), destination)
-        print("RequestFullRouteUpdateMessage sent to: " + print_hex(destination))
+                self.get_send_session_id(destination), \
+                None if table == None else (table[0], table[1])), destination)
+        if log_packet.isEnabledFor(logging.DEBUG):
+            log_packet.debug("RequestFullRouteUpdateMessage sent to: %s", print_hex(destination))
 
     #send identity message
     def request_send_identity(self, destination):
@@ -494,122 +854,583 @@ class PacketManager:
                 self.longid, \
                 destination, \
                 self.get_send_session_id(destination), \
-                self.nickname).get_packets(), destination)
-        print("SendIdentityMessage sent to: " + print_hex(
-            destination) + " nickname:" + self.nickname + " id:" + print_hex(self.longid))
-
-    #this thread function is executed periodically by a thread to generate keepalive messages
-    #with neighbours
-    def thread_function_send_keepalive(self):
-        while not self.keepalive_stop:
-            list_destinations = self.routing_manager.get_neighbour_destinations()
-            if debug == 1:
-                print("thread_function_send_keepalive destinations:", list_destinations)
-            for destination in list_destinations:
-                self.routing_manager.send(
-                    KeepaliveMessage(None, destination, self.get_send_session_id(destination)).get_packets(),
-                    destination)
-                if debug == 1:
-                    print("KeepaliveMessage sent to: " + print_hex(destination))
-            time.sleep(self.keepalive_interval)
-
-# class Node,
-# Each node in the network will be initialized and added to a list of nodes
-# Later it will be used to find the best forwarding table
-class Node(object):
-
-    def __init__(self, node): # Node class constructor
-        self.node = node # node name(id)
-        self.list = []
-        self.pre_node = None # if the node is connected to a previous node
-        self.distance = sys.maxsize # distance is set to max according to Bellman-Ford algorithm
-
-
-# Class Edge,
-# Each node is connected to at least one other node,
-# class edge connect these nodes together and put them in a list
-# it will be used in Bellman-ford to find the path
-class Edge(object):
-
-    def __init__(self, weight, start, end):
-        self.weight = weight # hop-count weight
-        self.start = start # starting node
-        self.end = end # destination node
-
-# Class Path,
-# this class connect and find the path to all nodes
-class Path(object):
-    def path(self, node_list, edge_list, start):
-        start.distance = 0
-        for i in range(0, len(node_list) - 1):
-            for x in edge_list:
-                u = x.start
-                v = x.end
-                distance2 = u.distance + x.weight
-                if distance2 < v.distance:
-                    v.distance = distance2
-                    v.pre_node = u
-
-    # This is the Bellman-Ford function that the program can send the destination and it returns the forwarding table
-    def getpath(self, target):
-        n = target
-        next_node = []
-        while n is not None:
-            next_node.append(n.node)
-            n = n.pre_node
-        forward_to = next_node[len(next_node) - 2]
-        return forward_to
+                self.nickname, \
+                self.send_receive.mtu), destination)
+        if log_packet.isEnabledFor(logging.DEBUG):
+            log_packet.debug("SendIdentityMessage sent to: %s nickname:%s id:%s", print_hex(destination), \
+                self.nickname, print_hex(self.longid))
+
+    #send a keepalive to a neighbour, they are single packets and all use keepalive_session_id, which no
+    #message gets: older nodes reassemble by session id, a keepalive there would end a message of ours in that session
+    def send_keepalive(self, destination):
+        self.routing_manager.send(KeepaliveMessage(None, destination, self.keepalive_session_id), destination)
+        if log_packet.isEnabledFor(logging.DEBUG):
+            log_packet.debug("KeepaliveMessage sent to: %s", print_hex(destination))
+
+# Class ShortestPathTree,
+# shortest paths from our node over the routing table, each row is an undirected edge between
+# destination and next hop with the hop count as weight
+# edges are changed one at a time and only the nodes whose distance or first hop changes are recomputed:
+# a lower weight is relaxed outwards from the edge (Dijkstra from there), a higher weight or a removed
+# tree edge detaches the subtree below it and recomputes only that subtree from its surroundings
+class ShortestPathTree(object):
+
+    def __init__(self, source):
+        self.source = source
+        self.edges = {source: {}} # node = {neighbour node: weight}
+        self.distance = {source: 0}
+        self.parent = {source: None}
+        self.children = {source: set()}
+        self.first_hop = {source: source}
+        self.changed = set() # nodes whose distance or first hop changed since last get_changes()
+
+    #set (weight) or remove (None) the edge between u and v
+    def set_edge(self, u, v, weight):
+        if u == v:
+            return
+        old = self.edges.get(u, {}).get(v)
+        if old == weight:
+            return
+        if weight == None:
+            del self.edges[u][v]
+            del self.edges[v][u]
+            for node in (u, v):
+                if len(self.edges[node]) == 0 and node != self.source:
+                    del self.edges[node]
+        else:
+            self.edges.setdefault(u, {})[v] = weight
+            self.edges.setdefault(v, {})[u] = weight
+        if weight != None and (old == None or weight < old):
+            heap = []
+            for (a, b) in ((u, v), (v, u)):
+                if a in self.distance and self.distance[a] + weight < self.distance.get(b, sys.maxsize):
+                    self.set_parent(b, a, self.distance[a] + weight)
+                    heapq.heappush(heap, (self.distance[b], b))
+            self.relax(heap)
+        else:
+            if self.parent.get(v) == u:
+                self.detach(v)
+            elif self.parent.get(u) == v:
+                self.detach(u)
+
+    def set_parent(self, node, parent, distance):
+        old_parent = self.parent.get(node)
+        if old_parent != None:
+            self.children[old_parent].discard(node)
+        self.parent[node] = parent
+        self.children.setdefault(parent, set()).add(node)
+        self.children.setdefault(node, set())
+        self.distance[node] = distance
+        self.changed.add(node)
+
+    #Dijkstra from the nodes in heap, that already have their new distance
+    def relax(self, heap):
+        updated = []
+        while len(heap) > 0:
+            (distance, node) = heapq.heappop(heap)
+            if distance > self.distance.get(node, sys.maxsize):
+                continue
+            updated.append(node)
+            for (neighbour, weight) in self.edges.get(node, {}).items():
+                if distance + weight < self.distance.get(neighbour, sys.maxsize):
+                    self.set_parent(neighbour, node, distance + weight)
+                    heapq.heappush(heap, (distance + weight, neighbour))
+        self.update_first_hops(updated)
+
+    #weight of the tree edge above node went up or the edge is gone, recompute the subtree below it
+    def detach(self, node):
+        subtree = []
+        stack = [node]
+        while len(stack) > 0:
+            current = stack.pop()
+            subtree.append(current)
+            stack.extend(self.children[current])
+        detached = set(subtree)
+        for current in subtree:
+            self.children[self.parent[current]].discard(current)
+            del self.parent[current]
+            del self.distance[current]
+            del self.first_hop[current]
+            self.changed.add(current)
+        for current in subtree:
+            self.children[current] = set()
+        heap = []
+        for current in subtree:
+            for (neighbour, weight) in self.edges.get(current, {}).items():
+                if neighbour in self.distance and neighbour not in detached and \
+                    self.distance[neighbour] + weight < self.distance.get(current, sys.maxsize):
+                    self.set_parent(current, neighbour, self.distance[neighbour] + weight)
+                    heapq.heappush(heap, (self.distance[current], current))
+        self.relax(heap)
+
+    #first hop of a node is the node itself for our neighbours, or the first hop of its parent,
+    #it is pushed down the subtree as far as it changes
+    def update_first_hops(self, nodes):
+        for node in sorted(nodes, key=lambda node: self.distance.get(node, sys.maxsize)):
+            if node not in self.distance:
+                continue
+            parent = self.parent[node]
+            first_hop = node if parent == self.source else self.first_hop[parent]
+            if self.first_hop.get(node) == first_hop:
+                continue
+            self.first_hop[node] = first_hop
+            self.changed.add(node)
+            stack = list(self.children[node])
+            while len(stack) > 0:
+                child = stack.pop()
+                if self.first_hop.get(child) != first_hop:
+                    self.first_hop[child] = first_hop
+                    self.changed.add(child)
+                    stack.extend(self.children[child])
+
+    #return and clear the set of changed nodes
+    def get_changes(self):
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+    #full recompute of all distances with Dijkstra
+    def rebuild(self):
+        self.changed.update(self.distance)
+        self.distance = {self.source: 0}
+        self.parent = {self.source: None}
+        self.children = {node: set() for node in self.edges}
+        self.first_hop = {self.source: self.source}
+        heap = [(0, self.source)]
+        while len(heap) > 0:
+            (distance, node) = heapq.heappop(heap)
+            if distance > self.distance[node]:
+                continue
+            for (neighbour, weight) in self.edges.get(node, {}).items():
+                if distance + weight < self.distance.get(neighbour, sys.maxsize):
+                    self.set_parent(neighbour, node, distance + weight)
+                    self.first_hop[neighbour] = neighbour if node == self.source else self.first_hop[node]
+                    heapq.heappush(heap, (distance + weight, neighbour))
+
+# Class RoutingTable,
+# routes (destination, next hop) = hop count, with indexes of the destinations per next hop
+# and the next hops per destination, so that the rows of a node are found without a scan
+class RoutingTable(object):
+
+    def __init__(self):
+        self.routes = {} # (destination, nexthop) = hopcount
+        self.by_nexthop = {} # nexthop = set of destinations
+        self.by_destination = {} # destination = set of nexthops
+
+    def __len__(self):
+        return len(self.routes)
+
+    def get(self, destination, nexthop):
+        return self.routes.get((destination, nexthop))
+
+    def set(self, destination, nexthop, hopcount):
+        self.routes[(destination, nexthop)] = hopcount
+        self.by_nexthop.setdefault(nexthop, set()).add(destination)
+        self.by_destination.setdefault(destination, set()).add(nexthop)
+
+    def remove(self, destination, nexthop):
+        if self.routes.pop((destination, nexthop), None) != None:
+            self.by_nexthop[nexthop].discard(destination)
+            if len(self.by_nexthop[nexthop]) == 0:
+                del self.by_nexthop[nexthop]
+            self.by_destination[destination].discard(nexthop)
+            if len(self.by_destination[destination]) == 0:
+                del self.by_destination[destination]
+
+    #rows that have node as destination or as next hop
+    def rows_of(self, node):
+        rows = [(node, nexthop) for nexthop in self.by_destination.get(node, ())]
+        rows.extend([(destination, node) for destination in self.by_nexthop.get(node, ()) if destination != node])
+        return rows
+
+    #all rows as (destination, nexthop, hopcount)
+    def rows(self):
+        return [(destination, nexthop, hopcount) for ((destination, nexthop), hopcount) in self.routes.items()]
 
 # Class Routing Manager,
 # This class manages the routing table, neighbors tables
 class RoutingManager:
     send_receive = None
     packet_manager = None
-    forwarding_table = {}
-    distance_table={}
 
-    def __init__(self, send_receive, longid):
+    def __init__(self, send_receive, longid, link_state=False):
 
         self.send_receive = send_receive
+        self.link_state = link_state # link state routing instead of distance vector
         self.id = longid  # pgp_id of my node
-        self.routingTable = [] # initializing routingTable
-        self.neighbors = [] # initializing neighbors table
-        self.routingTable.append({'DESTINATIONID': self.id, 'NEXTHOPID': self.id, 'HOPCOUNT': 0}) # adding my node to the routing table with hop count 0
+        self.routingTable = RoutingTable() # initializing routingTable
+        self.neighbors = {} # initializing neighbors table, longid = (host, port)
+        #ms of every route computation: bellman_ford, shortest_path_first and each incremental update_route
+        #(the route changes of distance vector, remove_node included)
+        self.compute_durations = Histogram(Metrics.duration_bounds)
+        self.forwarding_table = {} # destination = next hop
+        self.distance_table = {} # destination = hop count
+        self.pending_updates = {} # neighbour = set of destinations, triggered updates not sent yet
+        self.update_timers = {} # neighbour = timer handle of the pending update
+        self.last_update_sent = {} # neighbour = time (ms) of the last triggered update
+        self.hold_down = {} # destination = [hop count before it was lost, neighbours whose route was refused, timer]
+        self.link_state_database = {} # origin = (seq, {neighbour: cost}, time (ms) received)
+        #sequence numbers start from the clock, so that a restarted node is newer than its old advertisement
+        self.lsa_seq = int(time.time()) & 0xFFFFFFFF
+        self.lsa_timer = None
+        self.spf_timer = None
+        #table version, changes of the forwarding and distance table since a version can be sent as a delta
+        self.table_epoch = random.getrandbits(32) # new for every start of the node
+        self.table_version = 0
+        self.route_log = collections.deque(maxlen=self.route_log_size) # (version, destination) of changes
+        self.route_log_start = 0 # all changes after this version are in route_log
+        #routes advertised by neighbours, kept also while a neighbour is away, so that it only needs to send the
+        #changes since the version we have when it comes back: source = [epoch, version, {destination: hopcount}]
+        self.neighbour_tables = {}
+        #destination = ([equal cost next hops], loop-free backup next hop or None), filled on first use
+        #and emptied on every route change
+        self.next_hops = {}
+        self.next_hop_addresses = {} # destination = [(host, port)] for the forwarding fast path, same lifetime
+        self.neighbour_distances = {} # link state: neighbour = {destination: distance from the neighbour}
+        self.routingTable.set(self.id, self.id, 0) # adding my node to the routing table with hop count 0
         #generate new forwarding table after route update
         self.bellman_ford()
 
     def set_packet_manager(self, packet_manager):
         self.packet_manager = packet_manager
 
-    #generate forwarding and distance table
+    # triggered updates to a neighbour are collected for update_hold ms and sent as one message,
+    # with at least update_min_interval ms between two triggered updates to the same neighbour
+    update_hold = 200
+    update_min_interval = 1000
+    # hop counts from max_hopcount up are unreachable (0xFFFF)
+    max_hopcount = 16
+    # routes learned from a neighbour are advertised back to it as unreachable (poison reverse)
+    split_horizon = True
+    # a destination that got worse or was lost only accepts routes up to its old hop count
+    # for hold_down_time ms
+    hold_down_time = 3000
+
+    #queue triggered route updates of destinations for all neighbours except skip,
+    #the hop counts are taken when the update is sent
+    def queue_routing_update(self, destinations, skip=None):
+        for neighbour in self.get_neighbour_destinations():
+            if neighbour == skip:
+                continue
+            self.pending_updates.setdefault(neighbour, set()).update(destinations)
+            if neighbour not in self.update_timers:
+                now = self.send_receive.now()
+                delay = max(self.update_hold, self.last_update_sent.get(neighbour, 0) + self.update_min_interval - now)
+                self.update_timers[neighbour] = self.send_receive.loop.call_later(delay / 1000, \
+                    self.flush_routing_update, neighbour)
+
+    #send the collected triggered updates of a neighbour as one RouteUpdateMessage
+    def flush_routing_update(self, neighbour):
+        self.update_timers.pop(neighbour, None)
+        pending = self.pending_updates.pop(neighbour, None)
+        if pending and neighbour in self.neighbors:
+            routes = [(destination, self.advertised_hopcount(destination, neighbour)) for destination in pending]
+            self.packet_manager.request_send_routing_update(False, neighbour, routes)
+            self.last_update_sent[neighbour] = self.send_receive.now()
+
+    #drop the pending updates of a neighbour that is gone
+    def cancel_routing_update(self, neighbour):
+        timer = self.update_timers.pop(neighbour, None)
+        if timer != None:
+            timer.cancel()
+        self.pending_updates.pop(neighbour, None)
+        self.last_update_sent.pop(neighbour, None)
+
+    #hop count of destination as advertised to neighbour, unreachable (0xFFFF) when there is no route,
+    #the route reached max_hopcount or the route goes through the neighbour (split horizon)
+    def advertised_hopcount(self, destination, neighbour):
+        distance = self.distance_table.get(destination)
+        if distance == None or distance >= self.max_hopcount:
+            return 0xFFFF
+        if self.split_horizon and destination != neighbour and self.forwarding_table.get(destination) == neighbour:
+            return 0xFFFF
+        return distance
+
+    #destination got worse or unreachable, refuse routes longer than the old one for a while
+    def start_hold_down(self, destination, distance):
+        if self.hold_down_time <= 0 or self.send_receive == None:
+            return
+        timer = self.send_receive.loop.call_later(self.hold_down_time / 1000, self.end_hold_down, destination)
+        self.hold_down[destination] = [distance, set(), timer]
+
+    #hold-down is over (or the destination is back at the old hop count), neighbours whose route was refused
+    #are asked for a full update so the route is learned now
+    def end_hold_down(self, destination, expired=True):
+        entry = self.hold_down.pop(destination, None)
+        if entry == None:
+            return
+        entry[2].cancel()
+        if expired:
+            for neighbour in entry[1]:
+                if neighbour in self.neighbors:
+                    self.packet_manager.request_send_fullrouting_update(neighbour)
+
+    # own link state advertisement is sent again every lsa_refresh_interval ms,
+    # advertisements that were not refreshed in lsa_max_age ms are dropped
+    lsa_refresh_interval = 30000
+    lsa_max_age = 120000
+    # received advertisements are applied together after spf_delay ms
+    spf_delay = 20
+    # number of destination changes kept for delta route tables
+    route_log_size = 4096
+
+    #new table version for the destinations whose route changed
+    def log_route_changes(self, destinations):
+        if len(destinations) == 0:
+            return
+        self.table_version = (self.table_version + 1) & 0xFFFFFFFF
+        for destination in destinations:
+            if len(self.route_log) == self.route_log.maxlen:
+                self.route_log_start = self.route_log[0][0]
+            self.route_log.append((self.table_version, destination))
+
+    #((epoch, version, base), routes) as advertised to neighbour, only the changes since known_version
+    #(epoch, version) when they are all in the log, otherwise the whole table with base None
+    def get_routing_table_since(self, neighbour, known_version):
+        if known_version != None and known_version[0] == self.table_epoch and \
+            self.route_log_start <= known_version[1] <= self.table_version:
+            destinations = set([destination for (version, destination) in self.route_log if version > known_version[1]])
+            routes = [(destination, self.advertised_hopcount(destination, neighbour)) for destination in destinations]
+            return ((self.table_epoch, self.table_version, known_version[1]), routes)
+        return ((self.table_epoch, self.table_version, None), self.get_routing_table(neighbour))
+
+    #remember the routes from source, table_version is (epoch, version, base) for a compact route table
+    #and None for a legacy or triggered update, returns the routes to compare: the update itself, or for a
+    #compact table all routes we have from source now
+    #a delta is only applied to the version it was made for, one on another base (the answers to two requests
+    #crossed, or the table was dropped) is ignored, and when it is newer than ours the changes since the
+    #version we have are asked for again
+    def merge_neighbour_table(self, source, table_version, routes):
+        table = self.neighbour_tables.get(source)
+        if table_version == None:
+            merged = routes
+            if table == None:
+                return routes
+        else:
+            (epoch, version, base) = table_version
+            if base != None and (table == None or table[0] != epoch or table[1] != base):
+                if table == None or table[0] != epoch or version > table[1]:
+                    self.packet_manager.request_send_fullrouting_update(source)
+                return []
+            if table == None or base == None or table[0] != epoch:
+                table = [epoch, version, {}]
+                self.neighbour_tables[source] = table
+            table[1] = version
+        table[2].update(routes)
+        if table_version != None:
+            merged = list(table[2].items())
+        for (destination, hopcount) in routes:
+            if hopcount == 0xFFFF:
+                del table[2][destination]
+        return merged
+
+    #new own link state advertisement from the neighbours table, flooded to all neighbours
+    def originate_link_state(self):
+        self.lsa_seq = (self.lsa_seq + 1) & 0xFFFFFFFF
+        links = dict.fromkeys(self.neighbors, 1)
+        self.link_state_database[self.id] = (self.lsa_seq, links, self.send_receive.now())
+        for neighbour in self.get_neighbour_destinations():
+            self.packet_manager.request_send_link_state(neighbour, (self.id, self.lsa_seq, links))
+        if self.lsa_timer != None:
+            self.lsa_timer.cancel()
+        self.lsa_timer = self.send_receive.loop.call_later(self.lsa_refresh_interval / 1000, self.refresh_link_state)
+        self.shortest_path_first()
+
+    #drop old advertisements and send our own again
+    def refresh_link_state(self):
+        self.lsa_timer = None
+        now = self.send_receive.now()
+        for origin in [origin for (origin, (seq, links, received)) in self.link_state_database.items() \
+            if origin != self.id and now - received >= self.lsa_max_age]:
+            del self.link_state_database[origin]
+        self.originate_link_state()
+
+    #link state advertisement of origin received from neighbour, a newer one is stored and flooded further
+    def receive_link_state(self, neighbour, origin, seq, links):
+        if origin == self.id:
+            #our advertisement from before a restart, continue after its sequence number
+            if seq > self.lsa_seq:
+                self.lsa_seq = seq
+                self.originate_link_state()
+            return
+        current = self.link_state_database.get(origin)
+        if current != None and seq <= current[0]:
+            return
+        self.link_state_database[origin] = (seq, links, self.send_receive.now())
+        #a neighbour that does not list us yet (started after us) gets the whole database
+        if origin == neighbour and self.id not in links:
+            self.send_link_state_database(neighbour)
+        for destination in self.get_neighbour_destinations():
+            if destination != neighbour:
+                self.packet_manager.request_send_link_state(destination, (origin, seq, links))
+        self.schedule_shortest_path_first()
+
+    #advertisements of other nodes usually come in bursts, one shortest path first run covers them all
+    def schedule_shortest_path_first(self):
+        if self.spf_timer == None:
+            self.spf_timer = self.send_receive.loop.call_later(self.spf_delay / 1000, self.shortest_path_first)
+
+    #send all advertisements, except the neighbour's own, to neighbour
+    def send_link_state_database(self, neighbour):
+        for (origin, (seq, links, received)) in list(self.link_state_database.items()):
+            if origin != neighbour:
+                self.packet_manager.request_send_link_state(neighbour, (origin, seq, links))
+
+    #forwarding and distance table from the link state database (Dijkstra),
+    #a link is used only when both of its ends advertise it
+    def shortest_path_first(self):
+        if self.spf_timer != None:
+            self.spf_timer.cancel()
+            self.spf_timer = None
+        start = time.perf_counter()
+        spt = ShortestPathTree(self.id)
+        for (origin, (seq, links, received)) in self.link_state_database.items():
+            for (neighbour, cost) in links.items():
+                other = self.link_state_database.get(neighbour)
+                if neighbour != origin and other != None and origin in other[1]:
+                    spt.edges.setdefault(origin, {})[neighbour] = max(cost, other[1][origin])
+        spt.rebuild()
+        #distances from every neighbour, for the equal cost and backup next hops
+        self.neighbour_distances = {}
+        for neighbour in self.neighbors:
+            if neighbour in spt.edges:
+                tree = ShortestPathTree(neighbour)
+                tree.edges = spt.edges
+                tree.rebuild()
+                self.neighbour_distances[neighbour] = tree.distance
+        self.clear_next_hops()
+        new_destinations = [destination for destination in spt.distance \
+            if destination not in self.distance_table and destination != self.id]
+        self.log_route_changes([destination for destination in set(self.distance_table) | set(spt.distance) \
+            if self.distance_table.get(destination) != spt.distance.get(destination) or \
+                self.forwarding_table.get(destination) != spt.first_hop.get(destination)])
+        self.forwarding_table = dict(spt.first_hop)
+        self.distance_table = dict(spt.distance)
+        self.compute_durations.add((time.perf_counter() - start) * 1000)
+        #for new destinations, ask also host identity, once there is a route to send it on
+        for destination in new_destinations:
+            self.packet_manager.request_send_identity(destination)
+
+    #full recompute of forwarding and distance table from the routing table
+    #(Dijkstra, hop counts are never negative), route changes use update_route instead
     def bellman_ford(self):
-        #print("routingTable:",self.routingTable)
-        destinationlist = [n['DESTINATIONID'] for n in self.routingTable]
-        nextlist = [n['NEXTHOPID'] for n in self.routingTable]
-        nodes = list(dict.fromkeys(destinationlist + nextlist))
-        listofNodes = []
-        for i in nodes:
-            x = Node(i)
-            listofNodes.append(x)
-        listofEdges = []
-        for row in self.routingTable:
-            for i in listofNodes:
-                if row['DESTINATIONID'] == i.node:
-                    for j in listofNodes:
-                        if row['NEXTHOPID'] == j.node:
-                            y = Edge(row['HOPCOUNT'], i, j)
-                            listofEdges.append(y)
-                            y = Edge(row['HOPCOUNT'], j, i)
-                            listofEdges.append(y)
-
-        p = Path()
-        p.path(listofNodes, listofEdges, listofNodes[0])
-        self.forwarding_table={}
-        self.distance_table={}
-        for i in listofNodes:
-            self.forwarding_table[i.node] = p.getpath(i)
-            self.distance_table[i.node] = i.distance
-            #print("node:",i.node," next:",self.forwarding_table[i.node]," distance:",self.distance_table[i.node])
+        start = time.perf_counter()
+        self.spt = ShortestPathTree(self.id)
+        for ((destination, nexthop), hopcount) in self.routingTable.routes.items():
+            if destination != nexthop and hopcount < self.spt.edges.get(destination, {}).get(nexthop, sys.maxsize):
+                self.spt.edges.setdefault(destination, {})[nexthop] = hopcount
+                self.spt.edges.setdefault(nexthop, {})[destination] = hopcount
+        self.spt.rebuild()
+        self.spt.get_changes()
+        self.log_route_changes(set(self.distance_table) | set(self.spt.distance))
+        self.clear_next_hops()
+        self.forwarding_table = dict(self.spt.first_hop)
+        self.distance_table = dict(self.spt.distance)
+        self.compute_durations.add((time.perf_counter() - start) * 1000)
+
+    #set (hopcount) or remove (None) a single route and update forwarding and distance table for the
+    #destinations whose route changed, returns these destinations
+    def update_route(self, destination, nexthop, hopcount):
+        start = time.perf_counter()
+        if hopcount == None:
+            self.routingTable.remove(destination, nexthop)
+        else:
+            self.routingTable.set(destination, nexthop, hopcount)
+        weights = [weight for weight in (self.routingTable.get(destination, nexthop), \
+            self.routingTable.get(nexthop, destination)) if weight != None]
+        self.spt.set_edge(destination, nexthop, min(weights) if len(weights) > 0 else None)
+        changes = self.spt.get_changes()
+        self.log_route_changes(changes)
+        self.clear_next_hops()
+        for node in changes:
+            #a destination that got worse or was lost is held down, until it is back at the old hop count
+            old = self.distance_table.get(node)
+            entry = self.hold_down.get(node)
+            if node in self.spt.distance:
+                distance = self.spt.distance[node]
+                self.forwarding_table[node] = self.spt.first_hop[node]
+                self.distance_table[node] = distance
+                if entry != None and distance <= entry[0]:
+                    self.end_hold_down(node, False)
+                elif entry == None and old != None and distance > old:
+                    self.start_hold_down(node, old)
+            else:
+                self.forwarding_table.pop(node, None)
+                self.distance_table.pop(node, None)
+                if entry == None and old != None:
+                    self.start_hold_down(node, old)
+        self.compute_durations.add((time.perf_counter() - start) * 1000)
+        return changes
+
+    #distance from neighbour to destination, as the neighbour advertised it (distance vector) or from the
+    #link state database, None when unknown
+    def get_neighbour_distance(self, neighbour, destination):
+        if destination == neighbour:
+            return 0
+        if self.link_state:
+            return self.neighbour_distances.get(neighbour, {}).get(destination)
+        return self.routingTable.get(destination, neighbour)
+
+    #([equal cost next hops], backup next hop) of destination, the backup is the closest other neighbour whose
+    #own route does not come back through us (distance from it < 1 + our distance), or None
+    def get_next_hops(self, destination):
+        next_hops = self.next_hops.get(destination)
+        if next_hops == None:
+            distance = self.distance_table.get(destination)
+            equal = []
+            backup = None
+            backup_distance = None
+            if distance != None:
+                for neighbour in self.neighbors:
+                    neighbour_distance = self.get_neighbour_distance(neighbour, destination)
+                    if neighbour_distance == None or neighbour_distance >= self.max_hopcount:
+                        continue
+                    if neighbour_distance + 1 == distance:
+                        equal.append(neighbour)
+                    elif neighbour_distance < distance + 1 and \
+                        (backup_distance == None or neighbour_distance < backup_distance):
+                        backup = neighbour
+                        backup_distance = neighbour_distance
+                equal.sort()
+                if len(equal) == 0 and destination in self.forwarding_table:
+                    equal.append(self.forwarding_table[destination])
+            next_hops = (equal, backup)
+            self.next_hops[destination] = next_hops
+        return next_hops
+
+    def clear_next_hops(self):
+        self.next_hops.clear()
+        self.next_hop_addresses.clear()
+
+    #addresses of the neighbours a packet to destination can be sent to, the equal cost next hops or else the
+    #backup, empty when there is no route
+    def get_next_hop_addresses(self, destination):
+        addresses = self.next_hop_addresses.get(destination)
+        if addresses == None:
+            if destination in self.neighbors:
+                addresses = [self.neighbors[destination]]
+            else:
+                (equal, backup) = self.get_next_hops(destination)
+                addresses = [self.neighbors[neighbour] for neighbour in equal if neighbour in self.neighbors]
+                if len(addresses) == 0 and backup in self.neighbors:
+                    addresses = [self.neighbors[backup]]
+            self.next_hop_addresses[destination] = addresses
+        return addresses
+
+    #next hop for packet (a list of packets, or a message) to destination, the flow (source, destination, session_id)
+    #picks one of the equal cost next hops, the backup is used when none of them is a neighbour anymore
+    def select_next_hop(self, destination, packet):
+        (equal, backup) = self.get_next_hops(destination)
+        live = [neighbour for neighbour in equal if neighbour in self.neighbors]
+        if len(live) == 1:
+            return live[0]
+        if len(live) > 1:
+            if type(packet) == list:
+                packet = packet[0]
+            return live[hash((packet.source, packet.destination, packet.session_id)) % len(live)]
+        if backup != None and backup in self.neighbors:
+            return backup
+        return self.forwarding_table.get(destination)
 
     # The add function, for incoming packets
     def add(self, packet):
@@ -619,97 +1440,104 @@ class RoutingManager:
             self.packet_manager.add(packet)
         else:
             if packet.destination in self.forwarding_table:
-                destination = self.forwarding_table[packet.destination]
-                print("Forwarding:",print_hex(packet.destination),"-->",print_hex(destination))
+                destination = self.select_next_hop(packet.destination, packet)
+                if log_routing.isEnabledFor(logging.DEBUG):
+                    log_routing.debug("Forwarding: %s --> %s", print_hex(packet.destination), print_hex(destination))
+                #the payload is a view into the receive buffer, keep a copy while the packet is queued
+                packet.data = bytes(packet.data)
+                self.send_receive.metrics.count_packet("forwarded", packet.packet_type, \
+                    header_length(packet.session_id) + len(packet.data))
                 self.send(packet,destination)
             else:
-                print("No route to host:"+print_hex(packet.destination))
+                if log_routing.isEnabledFor(logging.INFO):
+                    log_routing.info("No route to host: %s", print_hex(packet.destination))
+                self.send_receive.metrics.counters["dropped_no_route"] += 1
 
     # add_neighbour, adds neighbour to the niegbours table and update the routing table
     def add_neighbour(self, host_port, longid):
 
-        print("Add neighbour:",print_hex(longid))
-        if longid not in [r['DESTINATIONID'] for r in self.routingTable]:
-            self.routingTable.append({'DESTINATIONID': longid, 'NEXTHOPID': self.id, 'HOPCOUNT': 1})
-        else:
-            for my_row in self.routingTable:
-                if my_row['DESTINATIONID'] == longid:
-                    my_row['HOPCOUNT'] = 1
-                    my_row['NEXTHOPID'] = self.id
-        #generate new forwarding table after route update
-        self.bellman_ford()
-
-        self.neighbors.append({'DESTINATIONID': longid, 'Weight': 1, 'HOST_PORT': host_port})
+        if log_routing.isEnabledFor(logging.INFO):
+            log_routing.info("Add neighbour: %s", print_hex(longid))
+        self.send_receive.watch_neighbour(longid)
+        if self.link_state:
+            self.neighbors[longid] = host_port
+            self.packet_manager.request_send_identity(longid)
+            self.originate_link_state()
+            self.send_link_state_database(longid)
+            return
+        changes = set()
+        for nexthop in list(self.routingTable.by_destination.get(longid, ())):
+            if nexthop != self.id:
+                changes.update(self.update_route(longid, nexthop, None))
+        #update forwarding table after route update
+        changes.update(self.update_route(longid, self.id, 1))
+
+        self.neighbors[longid] = host_port
         self.packet_manager.request_send_fullrouting_update(longid)
         self.packet_manager.request_send_identity(longid)
         
         #send update to neighbours also regarding addition
-        for destination in self.get_neighbour_destinations():
-            if destination!=longid:
-                self.packet_manager.request_send_routing_update(False, \
-                    destination, [(longid,1)])
+        changes.add(longid)
+        self.queue_routing_update(changes, longid)
 
     # get_all_destinations, returns all destinations in routing table
     def get_all_destinations(self):
-        destinations = set()
-        [destinations.add(n['DESTINATIONID']) for n in self.routingTable if n['DESTINATIONID'] != self.id]
+        if self.link_state:
+            destinations = set(self.distance_table)
+        else:
+            destinations = set(self.routingTable.by_destination)
+        destinations.discard(self.id)
         return destinations
 
     # get_neighbour_for_destination, returns a neighbours connected to a destination from neighbours table
     def get_neighbour_for_destination(self, destination):
-        neighbours = [n['HOST_PORT'] for n in self.neighbors if n['DESTINATIONID'] == destination]
-
-        if (len(neighbours) > 0):
-            return neighbours[0]
-        else:
-            return None
+        return self.neighbors.get(destination)
 
     # get_neighbour_destinations, returns all neighbours destinations from niegbours table
     def get_neighbour_destinations(self):
-        destinations = []
-        for row in self.neighbors:
-            destinations.append(row['DESTINATIONID'])
-        return destinations
+        return list(self.neighbors)
 
+    #send a packet, a list of packets, or a message (PacketCollection, split for the link it takes) to destination
     def send(self, packet, destination):
         # print("sending packet:"+str(packet)+" to destination:"+print_hex(destination))
-        if destination in self.get_neighbour_destinations():
-            self.send_receive.send(packet, self.get_neighbour_for_destination(destination))
+        neighbour = self.neighbors.get(destination)
+        if neighbour != None:
+            self.send_receive.send(packet, neighbour)
         else:
-            if destination in self.forwarding_table:
-                new_destination = self.forwarding_table[destination]
-                distance = self.distance_table[destination]
-                print("forwarding:"+print_hex(destination)+"-->"+print_hex(new_destination)+"("+str(distance)+")")
-                self.send_receive.send(packet,self.get_neighbour_for_destination(new_destination))
+            new_destination = self.select_next_hop(destination, packet)
+            if new_destination != None:
+                if log_routing.isEnabledFor(logging.DEBUG):
+                    log_routing.debug("forwarding: %s --> %s (%d)", print_hex(destination), \
+                        print_hex(new_destination), self.distance_table[destination])
+                self.send_receive.send(packet,self.neighbors.get(new_destination))
             else:
-                self.send_receive.send(packet,None)
+                #no route (yet), send the way the destination's packets come in, so that acks get back
+                self.send_receive.send(packet,self.send_receive.reverse_paths.get(destination))
 
     # remove_node, remove node from neighbors table (if exists) and routing table and all its connected routing table
     def remove_node(self, nodeid):
-        print("removing node:",nodeid)
-        new_neighbours=[]
-        for row in self.neighbors:
-            if row['DESTINATIONID'] != nodeid:
-                new_neighbours.append(row)
-        self.neighbors=new_neighbours
-        new_routingTable=[]
-        for row in self.routingTable:
-            if (row['DESTINATIONID'] != nodeid and row['NEXTHOPID'] != nodeid):
-                new_routingTable.append(row)
-        self.routingTable=new_routingTable
-        #generate new forwarding table after route update
-        self.bellman_ford()
+        if log_routing.isEnabledFor(logging.INFO):
+            log_routing.info("removing node: %s", print_hex(nodeid))
+        self.clear_next_hops()
+        if self.link_state:
+            if self.neighbors.pop(nodeid, None) != None:
+                self.originate_link_state()
+            return
+        self.neighbors.pop(nodeid, None)
+        self.cancel_routing_update(nodeid)
+        #update forwarding table after route update, only the rows of the node
+        changes = set([nodeid])
+        for (destination, nexthop) in self.routingTable.rows_of(nodeid):
+            changes.update(self.update_route(destination, nexthop, None))
         #send also update to neighbours regarding removal
-        for destination in self.get_neighbour_destinations():
-            if destination!=nodeid:
-                self.packet_manager.request_send_routing_update(False, \
-                    destination, [(nodeid,0xFFFF)])
+        self.queue_routing_update(changes, nodeid)
 
-    # get_routing_table, returns destinations and hop count for all routingtable and put them in a set
-    def get_routing_table(self):
+    # get_routing_table, returns destinations and hop count for all routingtable and put them in a set,
+    # as advertised to neighbour
+    def get_routing_table(self, neighbour):
         return_table = list()
         for destination in self.distance_table:
-            hopcount = self.distance_table[destination]
+            hopcount = self.advertised_hopcount(destination, neighbour)
             return_table.append((destination, hopcount))
         return return_table
 
@@ -717,54 +1545,36 @@ class RoutingManager:
     # and the table (or update records) received from a new node
     # it updates the routing table to get the optimized route 
     def compare_tables(self, table):
-        updates= [] #updates for other neighbours
-        newtable = []
-        for row in self.routingTable:
-            if row['DESTINATIONID'] == self.id:
-                newtable.append(
-                    {'DESTINATIONID': row['DESTINATIONID'], 'NEXTHOPID': row['NEXTHOPID'], 'HOPCOUNT': row['HOPCOUNT']})
-                break
-        temptable = table
-        for row in self.routingTable:
-            temp = False
-            for row2 in table:
-                if row['DESTINATIONID'] == row2['DESTINATIONID'] \
-                    and row['NEXTHOPID'] == row2['NEXTHOPID']:
-                    temp = True
-                    if row2['HOPCOUNT']==0xFFFF:
-                        updates.append(row2)
-                    elif row['HOPCOUNT'] <= row2['HOPCOUNT']:
-                        newtable.append(row)
-                    else:
-                        newtable.append(row2)
-                        updates.append(row2)
-                    temptable.remove(row2)
-            if temp is False and row not in newtable:
-                newtable.append(row)
+        updates= set() #destinations to update for other neighbours
         newentries=[]
-        for row in temptable:
-            if row not in newtable and row['HOPCOUNT']!=0xFFFF:
-                newtable.append(row)
-                newentries.append(row)
-                updates.append(row)
-        self.routingTable = newtable
-        #generate new forwarding table after route update
-        self.bellman_ford()
-        #for new entries, ask also host identity
+        for row in table:
+            destination = row['DESTINATIONID']
+            nexthop = row['NEXTHOPID']
+            hopcount = row['HOPCOUNT'] if row['HOPCOUNT'] < self.max_hopcount else 0xFFFF
+            current = self.routingTable.get(destination, nexthop)
+            #destination in hold-down, only a route up to the old hop count is taken
+            entry = self.hold_down.get(destination)
+            if entry != None and hopcount != 0xFFFF and hopcount + 1 > entry[0]:
+                entry[1].add(nexthop)
+                hopcount = 0xFFFF
+            if current != None:
+                if hopcount==0xFFFF:
+                    updates.update(self.update_route(destination, nexthop, None))
+                elif hopcount != current:
+                    #the same next hop reports a new hop count, also when it went up
+                    updates.update(self.update_route(destination, nexthop, hopcount))
+            elif hopcount!=0xFFFF:
+                reachable = destination in self.distance_table
+                updates.update(self.update_route(destination, nexthop, hopcount))
+                if not reachable:
+                    newentries.append(row)
+        #for new destinations (not for another route to a known one), ask also host identity
         for row in newentries:
             if row['DESTINATIONID']!=self.id:
                 self.packet_manager.request_send_identity(row['DESTINATIONID'])
-        #send updates to neighbours, about remove/add/update
-        routes=[]
-        for update in updates:
-            destination=update['DESTINATIONID']
-            if (update['HOPCOUNT']==0xFFFF):
-                routes.append((destination,0xFFFF))
-            else:
-                routes.append((destination,self.distance_table[destination]))
-        if len(routes)>0:
-            for destination in self.get_neighbour_destinations():
-                self.packet_manager.request_send_routing_update(False,destination,routes)
+        #send updates to neighbours, about remove/add/update of the destinations whose route changed
+        if len(updates)>0:
+            self.queue_routing_update(updates)
 
 #class to manager keyboard input
 class Keyboard(threading.Thread):
@@ -777,36 +1587,36 @@ class Keyboard(threading.Thread):
         self.send_receive = send_receive
 
     def run(self):
-        global debug
         while not self.stop_keyboard:
             print("Type /help for a list of commands")
             kbd_input = input("> ")
             if (kbd_input == "/debugon"):
-                debug = 1
-                # print("debug:",debug)
+                set_log_level("all", "debug")
             elif (kbd_input == "/debugoff"):
-                debug = 0
-                # print("debug:",debug)
+                set_log_level("all", "info")
+            elif (kbd_input == "/log"):
+                for (name, logger) in subsystems.items():
+                    print(name, [level for level in log_levels if log_levels[level] == logger.level][0])
+            elif (kbd_input.startswith("/log ")):
+                try:
+                    set_log_level(*kbd_input.split()[1:3])
+                except (KeyError, TypeError):
+                    print("usage: /log <" + "|".join(["all"] + list(subsystems)) + "> <" + "|".join(log_levels) + ">")
             elif (kbd_input == "/exit"):               
                 break
+            #the tables belong to the loop thread, they are printed there
             elif (kbd_input =="/routes"):
-                print("Destination","Nexthop","Hopcount")
-                for route in self.send_receive.routing_manager.routingTable:
-                    print (print_hex(route['DESTINATIONID']),\
-                        print_hex(route['NEXTHOPID']),\
-                        route['HOPCOUNT'])
+                self.submit(self.print_routes)
             elif (kbd_input =="/forward"):
-                print("Destination","NextHop")
-                for destination in self.send_receive.routing_manager.forwarding_table:
-                    print (print_hex(destination),\
-                        print_hex(self.send_receive.routing_manager.forwarding_table[destination]))
+                self.submit(self.print_forwarding_table)
             elif (kbd_input =="/distance"):
-                print("Destination","Distance")
-                for destination in self.send_receive.routing_manager.distance_table:
-                    print (print_hex(destination),\
-                        str(self.send_receive.routing_manager.distance_table[destination]))
+                self.submit(self.print_distance_table)
+            elif (kbd_input =="/linkstate"):
+                self.submit(self.print_link_state_database)
+            elif (kbd_input =="/stats"):
+                self.submit(self.print_stats)
             elif (kbd_input =="/bf"):
-                self.send_receive.routing_manager.bellman_ford()
+                self.submit(self.send_receive.routing_manager.bellman_ford)
             elif (kbd_input =="/self"):
                 print("self longid:",print_hex(self.send_receive.long_id))
             elif (kbd_input == "/help"):
@@ -816,37 +1626,454 @@ class Keyboard(threading.Thread):
                 print("/routes - list all routes")
                 print("/forward - list forwarding table")
                 print("/distance - list distance table")
+                print("/linkstate - list link state database (--link-state mode)")
+                print("/stats - packet, retransmit and drop counters, buffers, ack round trip times")
                 print("/self - print self longid")
                 print("/debugon - turn debugging on")
                 print("/debugoff - turn debugging off")
+                print("/log [<subsystem> <level>] - show or set the log levels of packet, routing and transport")
                 print("<message> - send message to all destinations")
                 print("/<nick> <message> - send message to <nick, for example /joe Hello!")
             elif (kbd_input != ""):
-                self.send_receive.keyboard(kbd_input)
+                self.submit(self.send_receive.packet_manager.send_text, kbd_input)
         self.send_receive.exit()
 
+    def submit(self, callback, *args):
+        if not self.send_receive.submit(callback, *args):
+            print("Node is busy, try again")
+
+    #the print methods run in the loop thread
+
+    def print_routes(self):
+        print("Destination","Nexthop","Hopcount")
+        for (destination, nexthop, hopcount) in self.send_receive.routing_manager.routingTable.rows():
+            print (print_hex(destination),\
+                print_hex(nexthop),\
+                hopcount)
+
+    def print_forwarding_table(self):
+        print("Destination","NextHop","EqualCost","Backup")
+        for destination in self.send_receive.routing_manager.forwarding_table:
+            (equal, backup) = self.send_receive.routing_manager.get_next_hops(destination)
+            print (print_hex(destination),\
+                print_hex(self.send_receive.routing_manager.forwarding_table[destination]),\
+                ",".join([print_hex(neighbour) for neighbour in equal]),\
+                print_hex(backup) if backup != None else "-")
+
+    def print_distance_table(self):
+        print("Destination","Distance")
+        for destination in self.send_receive.routing_manager.distance_table:
+            print (print_hex(destination),\
+                str(self.send_receive.routing_manager.distance_table[destination]))
+
+    def print_link_state_database(self):
+        print("Origin","Seq","Neighbour","Cost")
+        for (origin, (seq, links, received)) in self.send_receive.routing_manager.link_state_database.items():
+            for (neighbour, cost) in links.items():
+                print (print_hex(origin), seq, print_hex(neighbour), cost)
+
+    def print_stats(self):
+        stats = self.send_receive.get_stats()
+        print("Packets","Direction","Type","Count","Bytes")
+        for (direction, types) in stats["packets"].items():
+            for (packet_type, count) in types.items():
+                print("", direction, packet_type, count, stats["bytes"][direction][packet_type])
+        print("Counters")
+        for (name, value) in list(stats["counters"].items()) + list(stats["gauges"].items()):
+            print("", name, value)
+        print("Ack RTT (ms)","Peer","Count","Mean","p50","p90","p99")
+        for (peer, histogram) in self.send_receive.metrics.ack_rtt.items():
+            print("", print_hex(peer), histogram.count, round(histogram.sum / histogram.count, 1), \
+                histogram.percentile(0.5), histogram.percentile(0.9), histogram.percentile(0.99))
+        compute = self.send_receive.routing_manager.compute_durations
+        if compute.count > 0:
+            print("Route compute (ms)", "count:", compute.count, "mean:", round(compute.sum / compute.count, 3), \
+                "p90:", compute.percentile(0.9))
+
     def exit(self):
         self.stop_keyboard = True
 
+#round trip time estimator for a destination (RFC 6298)
+#the retransmission timeout doubles on every timeout and is reset by the next valid sample
+class RttEstimator:
+    min_rto = 200
+    max_rto = max_resend_interval
+    max_backoff = 64
+
+    def __init__(self, initial_rto):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.backoff = 1
+
+    #add a round trip time sample (ms), only for packets that were not retransmitted (Karn's rule)
+    def sample(self, rtt):
+        if self.srtt == None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + max(10, 4 * self.rttvar), self.min_rto), self.max_rto)
+        self.backoff = 1
+
+    #a packet timed out, back off exponentially
+    def timeout(self):
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+
+    #whole ms, resend deadlines are compared to now()
+    def get_rto(self):
+        return int(min(self.rto * self.backoff, self.max_rto))
+
+#deadline ordered timers, keys are removed lazily from the heap
+class TimerHeap:
+
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {} # key = deadline
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def push(self, key, deadline):
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        #drop the stale entries, when most of the heap is already cancelled
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(deadline, key) for key, deadline in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def remove(self, key):
+        self.deadlines.pop(key, None)
+
+    #pop and return all keys that are due at timestamp
+    def pop_due(self, timestamp):
+        due = []
+        while len(self.heap) > 0 and self.heap[0][0] <= timestamp:
+            (deadline, key) = heapq.heappop(self.heap)
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]
+                due.append(key)
+        return due
+
+    #earliest deadline, or None if there are no timers
+    def next_deadline(self):
+        while len(self.heap) > 0 and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if len(self.heap) > 0:
+            return self.heap[0][0]
+        return None
+
+#send window for a destination, limits the number of unacked fragments in flight
+#the window grows by one per ack until the first loss (slow start), then by one per window,
+#and is halved on loss
+class SendWindow:
+    initial_window = 4
+    max_window = 256
+
+    def __init__(self):
+        self.cwnd = self.initial_window
+        self.ssthresh = self.max_window
+        self.in_flight = set() # (destination, session_id, seq) of fragments sent but not acked
+        self.queue = collections.deque() # (packet, neighbour) waiting for the window to open
+
+    def is_open(self):
+        return len(self.in_flight) < int(self.cwnd)
+
+    def on_ack(self, packet_info):
+        if packet_info in self.in_flight:
+            self.in_flight.remove(packet_info)
+            if self.cwnd < self.ssthresh:
+                self.cwnd += 1
+            else:
+                self.cwnd += 1 / self.cwnd
+            self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_loss(self):
+        self.ssthresh = max(self.cwnd / 2, 2)
+        self.cwnd = self.ssthresh
+
+#fragments received in one session, used to acknowledge many fragments with one packet
+#the ack has flags 0x05, seq is the cumulative offset (everything up to it is received) and the
+#payload is the fragment size (2 bytes) followed by a bitmap of fragments received after the offset
+class SelectiveAck:
+    max_bitmap = 32 # bytes
+
+    def __init__(self, packet):
+        self.packet_type = packet.packet_type
+        self.source = packet.source
+        self.destination = packet.destination
+        self.session_id = packet.session_id
+        self.cumulative = 0
+        self.starts = {} # start offset = end offset (seq), for fragments after the cumulative offset
+        self.fragment_size = 0
+        self.total = None
+        self.unacked = 0
+        self.updated = 0
+        self.timer = None
+
+    def add(self, packet):
+        start = packet.seq - len(packet.data)
+        if packet.packet_flags == 0x02:
+            self.total = packet.seq
+        else:
+            self.fragment_size = max(self.fragment_size, len(packet.data))
+        if packet.seq > self.cumulative:
+            self.starts[start] = packet.seq
+        while self.cumulative in self.starts:
+            self.cumulative = self.starts.pop(self.cumulative)
+        self.unacked += 1
+
+    def is_complete(self):
+        return self.total != None and self.cumulative >= self.total
+
+    def get_ack_packet(self):
+        bitmap = bytearray()
+        for start in self.starts:
+            index = (start - self.cumulative) // self.fragment_size
+            if index < self.max_bitmap * 8:
+                while len(bitmap) <= index // 8:
+                    bitmap.append(0)
+                bitmap[index // 8] |= 1 << (index % 8)
+        self.unacked = 0
+        return Packet(self.packet_type, 0x05, self.destination, self.source, self.session_id, self.cumulative, \
+            self.fragment_size.to_bytes(2, byteorder='big') + bytes(bitmap))
+
+#histogram with fixed bucket bounds, counts[i] is the number of values up to bounds[i], the last count the
+#number of values above the last bound
+class Histogram:
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    #upper bound of the bucket that holds the given fraction of the values, None when empty
+    def percentile(self, fraction):
+        if self.count == 0:
+            return None
+        seen = 0
+        for (index, count) in enumerate(self.counts):
+            seen += count
+            if seen >= fraction * self.count:
+                return self.bounds[index] if index < len(self.bounds) else float("inf")
+
+    def to_dict(self):
+        return {"bounds": list(self.bounds), "counts": list(self.counts), "count": self.count, "sum": self.sum}
+
+#counters of a node, shown by /stats and served as JSON or Prometheus text on the stats socket (--stats)
+class Metrics:
+    packet_types = {0x00: "keepalive", 0x01: "route_update", 0x02: "full_route_request", 0x03: "full_route_update", \
+                    0x04: "identity", 0x05: "link_state", 0x06: "screen", 0x07: "binary"}
+    rtt_bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000) # ms
+    duration_bounds = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000) # ms
+
+    def __init__(self):
+        #direction (sent, received or forwarded) = packets and bytes, indexed by packet type
+        self.packets = {"sent": [0] * 8, "received": [0] * 8, "forwarded": [0] * 8}
+        self.bytes = {"sent": [0] * 8, "received": [0] * 8, "forwarded": [0] * 8}
+        self.counters = collections.Counter() # retransmits, drops and errors
+        self.ack_rtt = {} # destination = Histogram of ack round trip times (ms)
+        self.send_buffer_peak = 0
+        #the lists of the receive and forwarding fast path
+        self.received_packets = self.packets["received"]
+        self.received_bytes = self.bytes["received"]
+        self.sent_packets = self.packets["sent"]
+        self.sent_bytes = self.bytes["sent"]
+        self.forwarded_packets = self.packets["forwarded"]
+        self.forwarded_bytes = self.bytes["forwarded"]
+
+    def count_packet(self, direction, packet_type, length):
+        self.packets[direction][packet_type] += 1
+        self.bytes[direction][packet_type] += length
+
+    def add_rtt(self, destination, rtt):
+        histogram = self.ack_rtt.get(destination)
+        if histogram == None:
+            histogram = self.ack_rtt[destination] = Histogram(self.rtt_bounds)
+        histogram.add(rtt)
+
+#stats (SendAndReceive.get_stats) in the Prometheus text format
+def format_prometheus(stats):
+    lines = []
+    for name in ("packets", "bytes"):
+        lines.append("# TYPE cchat_" + name + "_total counter")
+        for (direction, types) in stats[name].items():
+            for (packet_type, value) in types.items():
+                lines.append("cchat_%s_total{direction=\"%s\",type=\"%s\"} %d" % (name, direction, packet_type, value))
+    for (name, value) in stats["counters"].items():
+        lines.append("# TYPE cchat_" + name + "_total counter")
+        lines.append("cchat_%s_total %d" % (name, value))
+    for (name, value) in stats["gauges"].items():
+        lines.append("# TYPE cchat_" + name + " gauge")
+        lines.append("cchat_%s %d" % (name, value))
+    histograms = [("ack_rtt_ms", "peer=\"%s\"" % peer, histogram) for (peer, histogram) in stats["ack_rtt_ms"].items()]
+    histograms.append(("route_compute_ms", "", stats["route_compute_ms"]))
+    typed = set()
+    for (name, label, histogram) in histograms:
+        if name not in typed:
+            typed.add(name)
+            lines.append("# TYPE cchat_" + name + " histogram")
+        cumulative = 0
+        for (bound, count) in zip(histogram["bounds"] + ["+Inf"], histogram["counts"]):
+            cumulative += count
+            lines.append("cchat_%s_bucket{%sle=\"%s\"} %d" % (name, label + "," if label != "" else "", bound, \
+                cumulative))
+        label = "{" + label + "}" if label != "" else ""
+        lines.append("cchat_%s_sum%s %s" % (name, label, histogram["sum"]))
+        lines.append("cchat_%s_count%s %d" % (name, label, histogram["count"]))
+    return "\n".join(lines) + "\n"
+
+#udp transport for the node protocol, reads the socket until it would block (up to receive_budget
+#datagrams per wakeup) into one preallocated buffer and writes packets with sendto directly
+#the data given to datagram_received is a view into the receive buffer, valid only during the call
+#it needs a loop that watches sockets with add_reader (a selector loop), the others raise NotImplementedError
+class BatchDatagramTransport:
+    receive_budget = 256
+    receive_buffer_size = 1024 * 1024 # SO_RCVBUF
+
+    def __init__(self, loop, sock, protocol):
+        self.loop = loop
+        self.sock = sock
+        self.protocol = protocol
+        self.recv_buffer = bytearray(65536)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.pending = collections.deque() # (data, addr) waiting for the socket to be writable
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
+        except OSError:
+            pass
+        sock.setblocking(False)
+        loop.add_reader(sock.fileno(), self.read_ready)
+        protocol.connection_made(self)
+
+    def read_ready(self):
+        for i in range(self.receive_budget):
+            try:
+                (length, addr) = self.sock.recvfrom_into(self.recv_buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as error:
+                self.protocol.error_received(error)
+                continue
+            self.protocol.datagram_received(self.recv_view[:length], addr)
+
+    def sendto(self, data, addr):
+        if len(self.pending) == 0:
+            try:
+                self.sock.sendto(data, addr)
+                return
+            except (BlockingIOError, InterruptedError):
+                self.loop.add_writer(self.sock.fileno(), self.write_ready)
+            except OSError as error:
+                self.protocol.error_received(error)
+                return
+        self.pending.append((bytes(data), addr))
+
+    def write_ready(self):
+        while len(self.pending) > 0:
+            (data, addr) = self.pending[0]
+            try:
+                self.sock.sendto(data, addr)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as error:
+                self.protocol.error_received(error)
+            self.pending.popleft()
+        self.loop.remove_writer(self.sock.fileno())
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        if len(self.pending) > 0:
+            self.loop.remove_writer(self.sock.fileno())
+        self.sock.close()
+
+#datagram protocol of the node, the transport calls it when the socket has data or an error
+class NodeProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, send_receive):
+        self.send_receive = send_receive
+
+    def connection_made(self, transport):
+        self.send_receive.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.send_receive.receive(data, addr)
+
+    def error_received(self, error):
+        if isinstance(error, ConnectionResetError):
+            return #skip the connection errors from printing on screen, in case neighbour lost
+        log_transport.warning("Error with a socket: %s", error, exc_info=log_transport.isEnabledFor(logging.DEBUG))
+
 #general class to manage sending and receiving, acks
+#everything runs as events in the asyncio loop: receiving, draining the send buffer, resends and keepalives
 class SendAndReceive:
-    # ack interval is 5 seconds
-    resend_interval = 5000
+    # initial retransmission timeout, until round trip times are measured
+    resend_interval = 1000
+    # a keepalive is sent to a neighbour nothing was received from for keepalive_interval ms, less a random
+    # part of up to keepalive_jitter so the neighbours are not probed together, any packet or ack received
+    # from the neighbour counts, a neighbour silent for keepalive_max_interval ms is dropped
+    keepalive_interval = 10000
+    keepalive_jitter = 0.25
     keepalive_max_interval = 40000
+    # largest datagram this node takes (--mtu)
+    mtu = max_packet_limit
+    # fast failure detection (--detect), like BFD: the keepalives are probes sent every probe_interval ms
+    # (probe_interval_range) on idle links, and a neighbour is dropped after probe_misses probes are not answered
+    probe_interval = None
+    probe_interval_range = (50, 500)
+    probe_misses = 3
     host_port = ("localhost", 5000)
     long_id = bytes().fromhex("0101010102020202")
     nickname = "joe"
-    send_buffer = [] #the main send buffer, (packet, (host port)) tuples will be put here
-    kbd_buffer = [] #keyboard input is put here
-    ack_buffer = {} # ack dictionary (destination, session_id, seq) = (packet, timestamp)
-    keepalive_buffer = {} #keepalive dictionary destination = timestap
-    do_exit = False
-    neighbours = {} #neighbour configuration dictionary, in case we have a neighbour drop and then wake up
-
-    def __init__(self, host_port, long_id, nickname):
+
+    #loop is the event loop to run on, a new one by default (nodes of the simulator share one)
+    def __init__(self, host_port, long_id, nickname, loop=None):
         self.host_port = host_port
         self.long_id = long_id
         self.nickname = nickname
+        self.loop = loop if loop != None else asyncio.new_event_loop()
+        self.send_buffer = collections.deque() #the main send buffer, (packet, (host port)) tuples will be put here
+        self.ack_buffer = {} # ack dictionary (destination, session_id, seq) = (packet, time first sent, retries)
+        self.last_heard = {} # neighbour = time (ms) a packet or ack was last received from it
+        self.neighbour_addresses = {} # (host, port) datagrams arrive from = neighbour
+        self.keepalive_timers = TimerHeap() # neighbour = time (ms) its liveness is checked next
+        self.link_limits = {} # (host, port) of a neighbour = largest datagram sent on the link
+        self.open_sessions = {} # (destination, session_id) = packets of our message queued or not acked yet
+        self.open_messages = {} # (destination, session_id) = (length, fragment size) of our message in it
+        self.closed_sessions = TimerHeap() # (destination, session_id) = time the id can be given out again
+        self.session_timer = None
+        self.waiting_messages = {} # destination = deque of our messages waiting for a free session id
+        self.do_exit = False
+        self.neighbours = {} #neighbour configuration dictionary, in case we have a neighbour drop and then wake up
+        self.transport = None
+        self.flush_scheduled = False
+        self.send_scratch = bytearray(65536) #packets are encoded here before sending
+        self.send_view = memoryview(self.send_scratch)
+        self.resend_timer = None
+        self.resend_timers = TimerHeap() # (destination, session_id, seq) = resend deadline
+        self.rtt_estimators = {} # destination = RttEstimator
+        self.send_windows = {} # destination = SendWindow
+        self.ack_sessions = {} # (destination, session_id) = set of seq in ack buffer
+        self.selective_acks = {} # (source, session_id) = SelectiveAck, for peers with "sack"
+        self.keepalive_timer = None
+        self.fast_forwarded = 0 # packets sent on by the forwarding fast path
+        self.reverse_paths = {} # source = (host, port) its last packet came from
+        self.metrics = Metrics()
+        self.inbox = collections.deque() # (callback, args) submitted by other threads, see submit
+        self.inbox_wakeup = False
+        self.stats_address = None # TCP port on localhost or UNIX socket path of the stats endpoint
+        self.stats_server = None
 
     def set_routing_manager(self, routing_manager):
         self.routing_manager = routing_manager
@@ -854,220 +2081,837 @@ class SendAndReceive:
     def set_packet_manager(self, packet_manager):
         self.packet_manager = packet_manager
 
-    # main send method, just append to buffer
+    #current loop time in milliseconds, rounded so a timer armed for deadline / 1000 sees deadline
+    def now(self):
+        return int(round(self.loop.time() * 1000))
+
+    # delay before a selective ack is sent, unless ack_every fragments are waiting or the message is complete
+    ack_delay = 20
+    ack_every = 8
+    # selective ack state is dropped when a session has been idle this long
+    selective_ack_ttl = 30000
+    # calls other threads can have waiting for the loop
+    inbox_size = 1024
+    # messages to one destination that can wait for a free session id, more are dropped
+    waiting_messages_limit = 1024
+    # longest a packet or its ack is on the way, relays give up resending a transit packet after it (check_resend)
+    packet_lifetime = 30000
+
+    # main send method, append to buffer and wake up the sender
+    # a message (PacketCollection) is split for the link to neighbour and for the path to its destination
+    # a message without session id (all were in use) waits until one is free again, see release_sessions
     def send(self, packet, neighbour):
+        if isinstance(packet, PacketCollection) and packet.session_id == None:
+            self.wait_for_session_id(packet)
+            return
+        if isinstance(packet, PacketCollection):
+            limit = min(self.link_limits.get(neighbour, packet_limit), \
+                self.packet_manager.get_path_mtu(packet.destination))
+            if packet.source in (None, self.long_id) and packet.packet_type != 0x00:
+                # selective acks of the session are checked against it
+                self.open_messages[(packet.destination, packet.session_id)] = \
+                    (len(packet.data), limit - header_length(packet.session_id))
+            packet = packet.get_packets(limit - header_length(packet.session_id))
         if (type(packet) == list):
             for single in packet:
-                self.send_buffer.append((single, neighbour))
+                self.send_packet(single, neighbour)
         else:
+            self.send_packet(packet, neighbour)
+        self.schedule_flush()
+
+    #fragments of our own messages go through the send window of the destination,
+    #everything else (single packets, acks, forwarded and resent packets) goes straight to the buffer
+    def send_packet(self, packet, neighbour):
+        if (packet.destination, packet.session_id, packet.seq) not in self.ack_buffer:
+            if packet.source in (None, self.long_id) and packet.packet_flags not in (0x04, 0x05) and \
+                packet.packet_type != 0x00:
+                # the session id stays in use until this packet is acked (remove_ack_info)
+                session = (packet.destination, packet.session_id)
+                self.open_sessions[session] = self.open_sessions.get(session, 0) + 1
+            if packet.packet_flags in (0x00, 0x01, 0x02) and packet.source in (None, self.long_id):
+                window = self.get_send_window(packet.destination)
+                if len(window.queue) > 0 or not window.is_open():
+                    window.queue.append((packet, neighbour))
+                    return
+                window.in_flight.add((packet.destination, packet.session_id, packet.seq))
+        self.send_buffer.append((packet, neighbour))
+
+    #the limit of the link to a neighbour is the smaller mtu of the two ends, peers that do not announce an mtu
+    #take packet_limit
+    def set_link_limit(self, neighbour, mtu):
+        address = self.routing_manager.get_neighbour_for_destination(neighbour)
+        if address != None:
+            self.link_limits[address] = min(self.mtu, mtu)
+
+    def get_send_window(self, destination):
+        if destination not in self.send_windows:
+            self.send_windows[destination] = SendWindow()
+            self.limit_send_window(destination)
+        return self.send_windows[destination]
+
+    #the destination refuses new messages while it holds reassembly_peer_bytes of ours, the window is kept
+    #to as many fragments of the path mtu so that everything in flight fits
+    def limit_send_window(self, destination):
+        window = self.send_windows.get(destination)
+        if window == None:
+            return
+        mtu = self.packet_manager.get_path_mtu(destination)
+        window.max_window = max(SendWindow.initial_window, \
+            min(SendWindow.max_window, self.packet_manager.reassembly_peer_bytes // mtu))
+        window.cwnd = min(window.cwnd, window.max_window)
+        window.ssthresh = min(window.ssthresh, window.max_window)
+
+    def wait_for_session_id(self, message):
+        self.metrics.counters["session_ids_exhausted"] += 1
+        waiting = self.waiting_messages.setdefault(message.destination, collections.deque())
+        if len(waiting) >= self.waiting_messages_limit:
+            if log_transport.isEnabledFor(logging.INFO):
+                log_transport.info("no free session id for: %s, message dropped", print_hex(message.destination))
+            self.metrics.counters["session_wait_dropped"] += 1
+            return
+        waiting.append(message)
+        self.arm_session_timer()
+
+    #send the messages waiting for a session id, in order, as long as ids are free
+    def send_waiting_messages(self, destination):
+        waiting = self.waiting_messages[destination]
+        while len(waiting) > 0:
+            session_id = self.packet_manager.find_send_session_id(destination)
+            if session_id == None:
+                return
+            message = waiting.popleft()
+            message.session_id = session_id
+            self.routing_manager.send(message, destination)
+        del self.waiting_messages[destination]
+
+    #the last packet of our message in the session is acked (or its destination dropped), the id is given out
+    #again only when no late copy of the message or of an ack can still come: packet_lifetime for the copy and
+    #as long for its ack, and for a message of more than one fragment also reassembly_ttl, until the time wait
+    #of the destination (PacketManager.is_late_copy) or what it reassembled of a late copy is over
+    def close_session(self, session):
+        self.open_sessions.pop(session, None)
+        (length, size) = self.open_messages.pop(session, (0, 1))
+        delay = 2 * self.packet_lifetime
+        if length > size:
+            delay += self.packet_manager.reassembly_ttl
+        self.closed_sessions.push(session, self.now() + delay)
+        self.arm_session_timer()
+
+    #arm the loop timer for the earliest closed session id, while messages wait for one
+    def arm_session_timer(self):
+        if self.session_timer != None or len(self.waiting_messages) == 0:
+            return
+        deadline = self.closed_sessions.next_deadline()
+        if deadline != None:
+            self.session_timer = self.loop.call_at(deadline / 1000, self.release_sessions)
+
+    #session ids are free again, send the messages waiting for them
+    def release_sessions(self):
+        self.session_timer = None
+        for destination in list(self.waiting_messages):
+            self.send_waiting_messages(destination)
+        self.arm_session_timer()
+
+    #move queued fragments to the send buffer as far as the window allows
+    def release_window(self, destination):
+        window = self.send_windows.get(destination)
+        if window == None:
+            return
+        while len(window.queue) > 0 and window.is_open():
+            (packet, neighbour) = window.queue.popleft()
+            window.in_flight.add((packet.destination, packet.session_id, packet.seq))
             self.send_buffer.append((packet, neighbour))
-
-    #input from keyboard
-    def keyboard(self, kbd_input):
-        self.kbd_buffer.append(kbd_input)
+        self.schedule_flush()
+
+    #drain the send buffer as soon as the loop is free, only one drain is scheduled at a time
+    def schedule_flush(self):
+        if not self.flush_scheduled and self.transport != None:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush_send_buffer)
+
+    #the loop thread owns all node state, other threads (the keyboard) hand work over with submit:
+    #callback(*args) is queued in the inbox and run by the loop, False when inbox_size calls are waiting already
+    def submit(self, callback, *args):
+        if len(self.inbox) >= self.inbox_size:
+            return False
+        self.inbox.append((callback, args))
+        #one wakeup of the loop covers all calls queued until the inbox is drained
+        if not self.inbox_wakeup:
+            self.inbox_wakeup = True
+            self.loop.call_soon_threadsafe(self.drain_inbox)
+        return True
+
+    def drain_inbox(self):
+        self.inbox_wakeup = False
+        while len(self.inbox) > 0:
+            (callback, args) = self.inbox.popleft()
+            try:
+                callback(*args)
+            except Exception as error:
+                log_transport.warning("Error in %s: %s", callback.__name__, error, \
+                    exc_info=log_transport.isEnabledFor(logging.DEBUG))
 
     #exit is called from Keyboard classs, when /exit is typed
     def exit(self):
-        #announce exit to neighbours
-        for destination in routing_manager.get_neighbour_destinations():
+        if self.loop.is_closed():
+            self.do_exit = True
+        else:
+            self.loop.call_soon_threadsafe(self.shutdown)
+
+    #announce exit to neighbours and stop the loop once the announcements are sent
+    def shutdown(self):
+        if self.do_exit:
+            return
+        for destination in self.routing_manager.get_neighbour_destinations():
             self.packet_manager.request_send_routing_update(True, \
                     destination, \
                         list())
-    
-        print("Exiting, please wait up to ", str(self.packet_manager.keepalive_interval) + "s")
+
+        print("Exiting")
         self.do_exit = True
-        self.packet_manager.keepalive_stop = True
+        self.loop.call_soon(self.loop.stop)
 
     #the main server program loop starts here
     def start(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(self.host_port)
+            protocol = NodeProtocol(self)
+            try:
+                BatchDatagramTransport(self.loop, sock, protocol)
+            except NotImplementedError:
+                #the loop cannot watch the socket (the proactor loop on Windows), asyncio's transport is used instead
+                self.loop.run_until_complete(self.loop.create_datagram_endpoint(lambda: protocol, sock=sock))
+            if self.stats_address != None:
+                self.start_stats_server()
+            self.start_timers()
+            self.loop.run_forever()
+        finally:
+            if self.transport != None:
+                self.transport.close()
+            if self.stats_server != None:
+                self.stats_server.close()
+                if not self.stats_address.isdigit():
+                    os.remove(self.stats_address)
+            self.loop.close()
+
+    #once the transport is there: send the packets queued before the loop started (neighbours from command line)
+    def start_timers(self):
+        self.schedule_flush()
+
+    #counters, gauges and histograms of the node, destinations in hex
+    def get_stats(self):
+        metrics = self.metrics
+        stats = {"packets": {}, "bytes": {}}
+        for name in ("packets", "bytes"):
+            for (direction, values) in getattr(metrics, name).items():
+                stats[name][direction] = {Metrics.packet_types[packet_type]: value \
+                    for (packet_type, value) in enumerate(values) if value > 0}
+        stats["counters"] = dict(metrics.counters)
+        stats["counters"]["fast_forwarded"] = self.fast_forwarded
+        if log_handler != None:
+            stats["counters"]["log_dropped"] = log_handler.dropped
+        for (name, value) in self.packet_manager.reassembly_counters.items():
+            stats["counters"]["reassembly_" + name] = value
+        stats["gauges"] = {
+            "send_buffer": len(self.send_buffer),
+            "send_buffer_peak": metrics.send_buffer_peak,
+            "ack_buffer": len(self.ack_buffer),
+            "send_window_queue": sum(len(window.queue) for window in list(self.send_windows.values())),
+            "reassembly_sessions": len(self.packet_manager.receive_sessions),
+            "reassembly_bytes": self.packet_manager.reassembly_bytes,
+            "neighbours": len(self.routing_manager.neighbors),
+            "destinations": len(self.routing_manager.distance_table),
+        }
+        stats["ack_rtt_ms"] = {print_hex(destination): histogram.to_dict() \
+            for (destination, histogram) in list(metrics.ack_rtt.items())}
+        stats["route_compute_ms"] = self.routing_manager.compute_durations.to_dict()
+        return stats
+
+    #stats endpoint on a TCP port of localhost (stats_address is a number) or a UNIX socket (a path)
+    def start_stats_server(self):
+        if self.stats_address.isdigit():
+            server = asyncio.start_server(self.serve_stats, "127.0.0.1", int(self.stats_address))
+        else:
+            server = asyncio.start_unix_server(self.serve_stats, self.stats_address)
+        self.stats_server = self.loop.run_until_complete(server)
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.bind(self.host_port)
-        # sock.listen(10)
-
-        while not self.do_exit:
-            time.sleep(.1)
-            # check for keyboard input
-            while (len(self.kbd_buffer) > 0):
-                kbd_input = self.kbd_buffer.pop(0)
-                self.packet_manager.send_text(kbd_input)
-                # print("Keyboard input:",kbd_input)
-
-            # check for packets for resend
-            timestamp = int(round(time.time() * 1000))
-
-            # resend the packets that have not been acked in self.resend_interval
-            resend_infos = [self.ack_buffer[packet_info] \
-                            for packet_info in self.ack_buffer \
-                            if (timestamp - self.ack_buffer[packet_info][1]) > self.resend_interval]
-            for resend_info in resend_infos:
-                if debug == 1:
-                    print("resending packet to destination:" + print_hex(resend_info[0].destination) + \
-                          " diff:" + str(timestamp - resend_info[1]))
-                self.routing_manager.send(resend_info[0], resend_info[0].destination)
-
-            # drop connection, if keepalive is not acked in resend_max_interval
-            drop_destinations = [destination \
-                                 for destination in self.keepalive_buffer \
-                                 if (timestamp - self.keepalive_buffer[destination]) > self.keepalive_max_interval]
-            for drop_destination in drop_destinations:
-                print("dropping neighbour destination:" + print_hex(drop_destination))
-                del self.keepalive_buffer[drop_destination]
-                self.routing_manager.remove_node(drop_destination)
-                # remove all packets drom ack buffer for destination
-                remove_packets = [packet_info \
-                    for packet_info in self.ack_buffer \
-                    if packet_info[0] == drop_destination]
-                for remove_packet in remove_packets:
-                    del self.ack_buffer[remove_packet]
-                # remove also packets for destination in send buffer
-                remove_packets = [packet_info for packet_info in self.send_buffer \
-                    if packet_info[0].destination==drop_destination]
-                for remove_packet in remove_packets:
-                    self.send_buffer.remove(remove_packet)
-
-            connections = [sock]
-            recv, write, err = select.select(connections, connections, connections)
-
-            for s in recv:
-                try:
-                    #receive data
-                    msg = s.recv(4096)
-                    # print("Recieved data:",print_hex(msg))
-                    packet = Packet.init_with_data(msg)
-                    if debug == 1:
-                        print("Recieved packet:", packet)
-                    # see if this is ack packet
-                    if (packet.packet_flags == 0x04):
-                        # see if it is an keepalive ack, remove antry from keepalive buffer for destination
-                        if (packet.packet_type == 0x00):
-                            del self.keepalive_buffer[packet.source]
-                        else:
-                            # this normal is ack packet, lets see if this packet is in ack_buffer and remove
-                            if (packet.source, packet.session_id, packet.seq) in self.ack_buffer:
-                                del self.ack_buffer[(packet.source, packet.session_id, packet.seq)]
-                    else:
-                        #see if neighbour is back
-                        if (packet.source in self.neighbours and \
-                            self.routing_manager.get_neighbour_for_destination(packet.source))==None:
-                            self.routing_manager.add_neighbour(self.neighbours[packet.source], packet.source)
-                        # ack sent packet
-                        self.routing_manager.send(packet.get_ack_packet(), packet.source)
-                        # add to routing manager for processing
-                        routing_manager.add(packet)
-                except ConnectionResetError:
-                    pass #skip the connection errors from printing on screen, in case neighbour lost
-                except Exception as error:
-                    print("Error recv:", error)
-                    if debug==1:
-                        traceback.print_exc()
-
-            for s in write:
-                #write data to socket
-                while (len(self.send_buffer) > 0):
-                    (packet, neighbour) = self.send_buffer.pop(0)
-                    if (packet.source == None):
-                        packet.source = self.long_id
-                    if debug == 1:
-                        print("Sending packet:", packet, "to:", neighbour)
-
-                    # add packet with timestamp to ack buffer (so that if ack is not received, packet is resent)
-                    # we do not add ack packets to ack buffer, add keepalive to keepalive buffer
-                    if packet.packet_flags != 0x04:
-                        if (packet.packet_type == 0x00):
-                            if packet.destination not in self.keepalive_buffer:
-                                self.keepalive_buffer[packet.destination] = int(round(time.time() * 1000))
-                        else:
-                            self.ack_buffer[(packet.destination, packet.session_id, packet.seq)] = \
-                                (packet, int(round(time.time() * 1000)))
-
-                    # send the packet
-                    try:
-                        if (neighbour != None):
-                            sent = s.sendto(packet.encode(), neighbour)
-                        else:
-                            print("No route to:" + print_hex(packet.destination))
-                    except Exception as error:
-                        print("Error send:", error)
-                        if debug==1:
-                            traceback.print_exc()
+    #a client sends a line "json" or "prometheus" (the default), or an HTTP GET request (JSON when the path
+    #ends with .json), and gets the stats, the connection is closed after that
+    async def serve_stats(self, reader, writer):
+        try:
+            line = (await asyncio.wait_for(reader.readline(), 5)).decode("ascii", "replace").strip()
+            http = line.startswith("GET ")
+            if http:
+                path = line.split(" ")[1] if len(line.split(" ")) > 1 else "/"
+                as_json = path.split("?")[0].endswith(".json")
+                #read the headers, the socket would be reset if they were left unread
+                while (await asyncio.wait_for(reader.readline(), 5)).strip() != b"":
+                    pass
+            else:
+                as_json = line == "json"
+            if as_json:
+                body = json.dumps(self.get_stats(), indent=1) + "\n"
+                content_type = "application/json"
+            else:
+                body = format_prometheus(self.get_stats())
+                content_type = "text/plain; version=0.0.4"
+            body = body.encode()
+            if http:
+                writer.write(("HTTP/1.0 200 OK\r\nContent-Type: " + content_type + "\r\nContent-Length: " + \
+                    str(len(body)) + "\r\n\r\n").encode())
+            writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def get_rtt_estimator(self, destination):
+        if destination not in self.rtt_estimators:
+            self.rtt_estimators[destination] = RttEstimator(self.resend_interval)
+        return self.rtt_estimators[destination]
+
+    def add_ack_info(self, packet_info, packet, retries):
+        previous = self.ack_buffer.get(packet_info)
+        self.ack_buffer[packet_info] = (packet, self.now() if previous == None else previous[1], retries)
+        session = (packet_info[0], packet_info[1])
+        if session not in self.ack_sessions:
+            self.ack_sessions[session] = set()
+        self.ack_sessions[session].add(packet_info[2])
+
+    def remove_ack_info(self, packet_info):
+        ack_info = self.ack_buffer.pop(packet_info)
+        self.resend_timers.remove(packet_info)
+        session = (packet_info[0], packet_info[1])
+        self.ack_sessions[session].discard(packet_info[2])
+        if len(self.ack_sessions[session]) == 0:
+            del self.ack_sessions[session]
+        if ack_info[0].source == self.long_id and session in self.open_sessions:
+            self.open_sessions[session] -= 1
+            if self.open_sessions[session] <= 0:
+                self.close_session(session)
+        return ack_info
+
+    #packet was acked by destination, update rtt and send window
+    def acknowledge(self, packet_info):
+        (packet, sent, retries) = self.remove_ack_info(packet_info)
+        if retries == 0:
+            self.get_rtt_estimator(packet_info[0]).sample(self.now() - sent)
+            self.metrics.add_rtt(packet_info[0], self.now() - sent)
+        if packet_info[0] in self.send_windows:
+            self.send_windows[packet_info[0]].on_ack(packet_info)
+
+    #clear all fragments of a session covered by a cumulative and selective ack
+    def receive_selective_ack(self, packet):
+        session = (packet.source, packet.session_id)
+        if session not in self.ack_sessions or len(packet.data) < 2:
+            return
+        fragment_size = int.from_bytes(packet.data[0:2], byteorder='big')
+        bitmap = packet.data[2:]
+        if session in self.open_messages and not self.matches_message(packet, fragment_size, bitmap):
+            self.metrics.counters["selective_acks_rejected"] += 1
+            return
+        for seq in list(self.ack_sessions[session]):
+            packet_info = (packet.source, packet.session_id, seq)
+            acked = seq <= packet.seq
+            if not acked and fragment_size > 0:
+                sent = self.ack_buffer[packet_info][0]
+                (index, offset) = divmod(seq - len(sent.data) - packet.seq, fragment_size)
+                #a bit covers fragment_size bytes, or up to the end of the message
+                acked = offset == 0 and (len(sent.data) == fragment_size or \
+                    (sent.packet_flags == 0x02 and len(sent.data) <= fragment_size)) and \
+                    index // 8 < len(bitmap) and (bitmap[index // 8] >> (index % 8)) & 1 == 1
+            if acked:
+                self.acknowledge(packet_info)
+        self.release_window(packet.source)
+
+    #a selective ack of our message must fit it: the cumulative offset at a fragment boundary or the end, the
+    #fragment size ours, and no bit past the last fragment. Anything else is not about the message in the session
+    def matches_message(self, packet, fragment_size, bitmap):
+        (length, size) = self.open_messages[(packet.source, packet.session_id)]
+        if packet.seq > length or (packet.seq != length and packet.seq % size != 0):
+            return False
+        if fragment_size != 0 and fragment_size != size:
+            return False
+        for index in range(len(bitmap) - 1, -1, -1):
+            if bitmap[index] != 0:
+                return packet.seq + (index * 8 + bitmap[index].bit_length() - 1) * size < length
+        return True
+
+    #ack a received data packet, fragments from peers with selective acks are acked together
+    def send_ack(self, packet):
+        if packet.packet_flags in (0x00, 0x01, 0x02) and self.use_selective_ack(packet.source):
+            session = (packet.source, packet.session_id)
+            selective_ack = self.selective_acks.get(session)
+            if selective_ack == None:
+                selective_ack = SelectiveAck(packet)
+                self.selective_acks[session] = selective_ack
+                self.loop.call_later(self.selective_ack_ttl / 1000, self.expire_selective_ack, session)
+            selective_ack.add(packet)
+            selective_ack.updated = self.now()
+            if selective_ack.fragment_size > 0:
+                if selective_ack.unacked >= self.ack_every or selective_ack.is_complete():
+                    self.flush_selective_ack(session)
+                elif selective_ack.timer == None:
+                    selective_ack.timer = self.loop.call_later(self.ack_delay / 1000, \
+                        self.flush_selective_ack, session)
+                return
+        self.routing_manager.send(packet.get_ack_packet(), packet.source)
+
+    #selective acks are used, when the source and every next hop an ack to it can take (the equal cost next
+    #hops and the backup too) support them, without a route the ack goes back the way the packet came and
+    #plain acks are used
+    def use_selective_ack(self, source):
+        if not self.packet_manager.has_capability(source, "sack"):
+            return False
+        if source in self.routing_manager.neighbors:
+            return True
+        (equal, backup) = self.routing_manager.get_next_hops(source)
+        next_hops = set(equal)
+        if backup != None:
+            next_hops.add(backup)
+        if source in self.routing_manager.forwarding_table:
+            next_hops.add(self.routing_manager.forwarding_table[source])
+        return len(next_hops) > 0 and \
+            all([self.packet_manager.has_capability(next_hop, "sack") for next_hop in next_hops])
+
+    def flush_selective_ack(self, session):
+        selective_ack = self.selective_acks.get(session)
+        if selective_ack == None:
+            return
+        if selective_ack.timer != None:
+            selective_ack.timer.cancel()
+            selective_ack.timer = None
+        if selective_ack.unacked > 0 and selective_ack.fragment_size > 0:
+            self.routing_manager.send(selective_ack.get_ack_packet(), selective_ack.source)
+        if selective_ack.is_complete():
+            del self.selective_acks[session]
+
+    def expire_selective_ack(self, session):
+        selective_ack = self.selective_acks.get(session)
+        if selective_ack == None:
+            return
+        idle = self.now() - selective_ack.updated
+        if idle < self.selective_ack_ttl:
+            self.loop.call_later((self.selective_ack_ttl - idle) / 1000, self.expire_selective_ack, session)
+        else:
+            self.flush_selective_ack(session)
+            self.selective_acks.pop(session, None)
+
+    #arm the loop timer for the earliest resend deadline
+    def arm_resend_timer(self):
+        deadline = self.resend_timers.next_deadline()
+        if self.resend_timer != None:
+            if deadline != None and self.resend_timer.when() <= deadline / 1000:
+                return
+            self.resend_timer.cancel()
+            self.resend_timer = None
+        if deadline != None:
+            self.resend_timer = self.loop.call_at(deadline / 1000, self.check_resend)
+
+    # resend the packets whose retransmission timeout has passed
+    def check_resend(self):
+        self.resend_timer = None
+        timestamp = self.now()
+        backed_off = set()
+        for packet_info in self.resend_timers.pop_due(timestamp):
+            if packet_info not in self.ack_buffer:
+                continue
+            (packet, sent, retries) = self.ack_buffer[packet_info]
+            if packet.source != self.long_id and timestamp - sent >= self.packet_lifetime:
+                # a transit packet is not resent beyond its lifetime, its source may give the session id out again
+                self.remove_ack_info(packet_info)
+                self.metrics.counters["transit_expired"] += 1
+                continue
+            self.ack_buffer[packet_info] = (packet, sent, retries + 1)
+            self.metrics.counters["retransmits"] += 1
+            #back off once per timeout round for a destination, not once per lost packet
+            if packet.destination not in backed_off:
+                backed_off.add(packet.destination)
+                self.get_rtt_estimator(packet.destination).timeout()
+                if packet.destination in self.send_windows:
+                    self.send_windows[packet.destination].on_loss()
+            if log_transport.isEnabledFor(logging.DEBUG):
+                log_transport.debug("resending packet to destination:%s diff:%d retries:%d", \
+                    print_hex(packet.destination), timestamp - sent, retries + 1)
+            self.routing_manager.send(packet, packet.destination)
+        self.arm_resend_timer()
+
+    #start checking the liveness of a neighbour, called when it is added
+    def watch_neighbour(self, neighbour):
+        self.last_heard[neighbour] = self.now()
+        self.schedule_keepalive(neighbour, self.last_heard[neighbour])
+
+    #check the neighbour keepalive_interval (less jitter) ms after since, and when it has to be dropped at the latest
+    def schedule_keepalive(self, neighbour, since):
+        interval = int(self.keepalive_interval * (1 - random.uniform(0, self.keepalive_jitter)))
+        self.keepalive_timers.push(neighbour, \
+            min(since + interval, self.last_heard[neighbour] + self.keepalive_max_interval))
+        self.arm_keepalive_timer()
+
+    #arm the loop timer for the earliest liveness check
+    def arm_keepalive_timer(self):
+        deadline = self.keepalive_timers.next_deadline()
+        if self.keepalive_timer != None:
+            if deadline != None and self.keepalive_timer.when() <= deadline / 1000:
+                return
+            self.keepalive_timer.cancel()
+            self.keepalive_timer = None
+        if deadline != None:
+            self.keepalive_timer = self.loop.call_at(deadline / 1000, self.check_keepalive)
+
+    #switch to fast failure detection, the neighbours already watched are checked at the new interval
+    def set_probe_interval(self, interval):
+        self.probe_interval = interval
+        self.keepalive_interval = interval
+        self.keepalive_max_interval = interval * self.probe_misses
+        for neighbour in list(self.last_heard):
+            self.keepalive_timers.remove(neighbour)
+            self.schedule_keepalive(neighbour, self.now())
+
+    # neighbours with traffic only get their next check, idle ones a keepalive, silent ones are dropped
+    def check_keepalive(self):
+        self.keepalive_timer = None
+        timestamp = self.now()
+        for neighbour in self.keepalive_timers.pop_due(timestamp):
+            if neighbour not in self.routing_manager.neighbors:
+                # removed, watched again when it is added back
+                self.last_heard.pop(neighbour, None)
+                continue
+            idle = timestamp - self.last_heard[neighbour]
+            if idle >= self.keepalive_max_interval:
+                self.drop_neighbour(neighbour)
+            elif idle >= self.keepalive_interval * (1 - self.keepalive_jitter):
+                self.packet_manager.send_keepalive(neighbour)
+                self.schedule_keepalive(neighbour, timestamp)
+            else:
+                self.schedule_keepalive(neighbour, self.last_heard[neighbour])
+        self.arm_keepalive_timer()
+
+    # drop connection to a neighbour nothing was heard from in keepalive_max_interval, its routes are removed
+    # right away so traffic fails over to the other neighbours
+    def drop_neighbour(self, drop_destination):
+        if log_transport.isEnabledFor(logging.INFO):
+            log_transport.info("dropping neighbour destination: %s silent for %d ms", print_hex(drop_destination), \
+                self.now() - self.last_heard[drop_destination])
+        self.metrics.counters["neighbours_dropped"] += 1
+        self.last_heard.pop(drop_destination, None)
+        self.routing_manager.remove_node(drop_destination)
+        # remove all packets drom ack buffer for destination
+        remove_packets = [packet_info \
+            for packet_info in self.ack_buffer \
+            if packet_info[0] == drop_destination]
+        for remove_packet in remove_packets:
+            self.remove_ack_info(remove_packet)
+        # remove also packets for destination in send buffer
+        remove_packets = [packet_info for packet_info in self.send_buffer \
+            if packet_info[0].destination==drop_destination]
+        for remove_packet in remove_packets:
+            self.send_buffer.remove(remove_packet)
+        self.send_windows.pop(drop_destination, None)
+        # the queued packets are gone too, their session ids are closed
+        for session in [session for session in self.open_sessions if session[0] == drop_destination]:
+            self.close_session(session)
+        self.waiting_messages.pop(drop_destination, None)
+
+    # transit packets, and acks of packets we did not forward ourselves, are sent on unchanged to the next hop,
+    # they are then acked end to end instead of by every relay
+    cut_through = True
+
+    #forwarding fast path, only the header fields are read from the datagram, returns False when the packet
+    #has to go through the normal path (it is for us, there is no route, or we keep state for it)
+    def forward_fast(self, msg):
+        if msg[0] < 0x40:
+            (first_byte, source, destination, session_id, seq) = packet_header.unpack_from(msg)
+        elif msg[0] < 0x80:
+            (first_byte, source, destination, session_id, seq) = packet_header_wide.unpack_from(msg)
+        else:
+            return False
+        if destination == self.long_id:
+            return False
+        if first_byte & 0x07 in (0x04, 0x05):
+            # acks of packets we forwarded on the normal path (they wait in our ack buffer) end here
+            seqs = self.ack_sessions.get((source, session_id))
+            if seqs and self.ack_buffer[(source, session_id, next(iter(seqs)))][0].source == destination:
+                return False
+        elif source in self.neighbours and source not in self.routing_manager.neighbors:
+            # neighbour is back, the normal path adds it again
+            return False
+        addresses = self.routing_manager.next_hop_addresses.get(destination)
+        if addresses == None:
+            addresses = self.routing_manager.get_next_hop_addresses(destination)
+        if len(addresses) == 0:
+            return False
+        if len(addresses) == 1:
+            address = addresses[0]
+        else:
+            address = addresses[hash((source, destination, session_id)) % len(addresses)]
+        self.transport.sendto(msg, address)
+        self.fast_forwarded += 1
+        #counted as forwarded and as sent
+        packet_type = (first_byte >> 3) & 0x07
+        metrics = self.metrics
+        metrics.forwarded_packets[packet_type] += 1
+        metrics.forwarded_bytes[packet_type] += len(msg)
+        metrics.sent_packets[packet_type] += 1
+        metrics.sent_bytes[packet_type] += len(msg)
+        return True
+
+    #incoming datagram
+    def receive(self, msg, addr):
+        try:
+            self.metrics.received_packets[(msg[0] >> 3) & 0x07] += 1
+            self.metrics.received_bytes[(msg[0] >> 3) & 0x07] += len(msg)
+            # any datagram from a neighbour shows it is alive
+            neighbour = self.neighbour_addresses.get(addr)
+            if neighbour != None:
+                self.last_heard[neighbour] = self.now()
+            if self.cut_through and len(msg) >= packet_header_length and self.forward_fast(msg):
+                return
+            packet = Packet.init_with_data(msg)
+            if log_transport.isEnabledFor(logging.DEBUG):
+                # the payload is a view into the receive buffer, the record gets a copy
+                log_transport.debug("Received packet: %s", Packet.init_with_data(bytes(msg)))
+            if packet.source != neighbour and packet.source in self.routing_manager.neighbors:
+                # the neighbour sends from this address
+                self.neighbour_addresses[addr] = packet.source
+                self.last_heard[packet.source] = self.now()
+            # see if this is ack packet
+            if (packet.packet_flags == 0x04):
+                # keepalive acks only show the neighbour is alive (last_heard)
+                if (packet.packet_type != 0x00):
+                    # this normal is ack packet, lets see if this packet is in ack_buffer and remove
+                    packet_info = (packet.source, packet.session_id, packet.seq)
+                    if packet_info in self.ack_buffer:
+                        self.acknowledge(packet_info)
+                        self.release_window(packet.source)
+            elif (packet.packet_flags == 0x05):
+                self.receive_selective_ack(packet)
+            else:
+                #see if neighbour is back
+                if (packet.source in self.neighbours and \
+                    self.routing_manager.get_neighbour_for_destination(packet.source))==None:
+                    self.routing_manager.add_neighbour(self.neighbours[packet.source], packet.source)
+                self.reverse_paths[packet.source] = addr
+                if packet.destination == self.long_id and self.packet_manager.is_late_copy(packet):
+                    self.routing_manager.send(packet.get_ack_packet(), packet.source)
+                    return
+                # without room to reassemble it the packet is dropped unacked, the sender resends it
+                if packet.destination == self.long_id and not self.packet_manager.has_room(packet):
+                    return
+                # ack sent packet and add to routing manager for processing
+                self.send_ack(packet)
+                self.routing_manager.add(packet)
+        except Exception as error:
+            log_transport.warning("Error recv: %s", error, exc_info=log_transport.isEnabledFor(logging.DEBUG))
+            self.metrics.counters["receive_errors"] += 1
+
+    #write the whole send buffer to the socket
+    def flush_send_buffer(self):
+        self.flush_scheduled = False
+        if len(self.send_buffer) > self.metrics.send_buffer_peak:
+            self.metrics.send_buffer_peak = len(self.send_buffer)
+        while (len(self.send_buffer) > 0):
+            (packet, neighbour) = self.send_buffer.popleft()
+            if (packet.source == None):
+                packet.source = self.long_id
+            if log_transport.isEnabledFor(logging.DEBUG):
+                log_transport.debug("Sending packet: %s to: %s", packet, neighbour)
+
+            # add packet with timestamp to ack buffer (so that if ack is not received, packet is resent)
+            # we do not add ack packets to ack buffer, keepalives are not resent either (check_keepalive
+            # sends the next one while the neighbour stays silent)
+            if packet.packet_flags not in (0x04, 0x05) and packet.packet_type != 0x00:
+                packet_info = (packet.destination, packet.session_id, packet.seq)
+                retries = 0
+                if packet_info in self.ack_buffer:
+                    retries = self.ack_buffer[packet_info][2]
+                self.add_ack_info(packet_info, packet, retries)
+                self.resend_timers.push(packet_info, \
+                    self.now() + self.get_rtt_estimator(packet.destination).get_rto())
+
+            # send the packet
+            try:
+                if (neighbour != None):
+                    length = packet.encode_into(self.send_scratch)
+                    self.transport.sendto(self.send_view[:length], neighbour)
+                    self.metrics.count_packet("sent", packet.packet_type, length)
+                else:
+                    if log_transport.isEnabledFor(logging.INFO):
+                        log_transport.info("No route to: %s", print_hex(packet.destination))
+                    self.metrics.counters["dropped_no_route"] += 1
+            except Exception as error:
+                log_transport.warning("Error send: %s", error, exc_info=log_transport.isEnabledFor(logging.DEBUG))
+                self.metrics.counters["send_errors"] += 1
 
-            for s in err:
-                print("Error with a socket")
-                if debug==1:
-                        traceback.print_exc()
-                s.close()
-                connections.remove(s)
+        self.arm_resend_timer()
 
 
 def help():
     print("Syntax:")
     print("", sys.argv[0],
-          " <host> <port> <longid> <nickname> [ <neighbour host> <neighbour port> <neighbour longid> ]... ")
+          " [--link-state] [--detect <probe interval ms>] [--mtu <bytes>] [--stats <port or socket path>] [--log <subsystem>=<level>,...] <host> <port> <longid> <nickname> [ <neighbour host> <neighbour port> <neighbour longid> ]... ")
     print("Example")
     print("", sys.argv[0], " localhost 5005 0101010102020202 jimmy")
 
 
-print("length:", str(len(sys.argv)))
-print("argv:", sys.argv)
-
 #helper function to print the bytes
 def print_hex(data_bytes):
     msg = ""
-    if (type(data_bytes) == bytes and len(data_bytes) > 0):
-        msg = ''.join(['{:02x}'.format(b) for b in data_bytes])
+    if (type(data_bytes) in (bytes, bytearray, memoryview) and len(data_bytes) > 0):
+        msg = bytes(data_bytes).hex()
     elif len(data_bytes) > 0:
         print("Wrong type for print_hex:" + str(type(data_bytes)))
 
     return msg
 
-# neighbor can be set only on command line
-# parse command line
-if (len(sys.argv) >= 5):
+#set the level ("debug", "info", "warning" or "off") of a subsystem, or of "all"
+def set_log_level(subsystem, level):
+    for name in (subsystems if subsystem == "all" else [subsystem]):
+        subsystems[name].setLevel(log_levels[level])
+
+#log records are queued here and written by a background thread, when the writer falls behind
+#(a slow terminal) records are dropped instead of blocking the event loop
+class DroppingQueueHandler(logging.handlers.QueueHandler):
 
-    if (len(bytes().fromhex(sys.argv[3])) == 8):
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
 
-        #initialize all classes
-        send_receive = SendAndReceive((sys.argv[1], int(sys.argv[2])), bytes().fromhex(sys.argv[3]), sys.argv[4])
-        routing_manager = RoutingManager(send_receive, bytes().fromhex(sys.argv[3]))
-        packet_manager = PacketManager(routing_manager, bytes().fromhex(sys.argv[3]), sys.argv[4])
-        routing_manager.set_packet_manager(packet_manager)
-        send_receive.set_routing_manager(routing_manager)
-        send_receive.set_packet_manager(packet_manager)
-        keyboard = Keyboard(send_receive)
-        keyboard.daemon = True
+    #the record is queued unformatted, the writer thread formats it (QueueHandler.prepare formats on the loop
+    #thread), so the arguments of a record must not change after it is logged
+    def prepare(self, record):
+        return record
 
-        #parse neighbours from command line
+    def enqueue(self, record):
         try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+#write the log records to stdout from a background thread, at most size records wait
+def start_logging(size=10000):
+    global log_handler, log_listener
+    records = queue.Queue(size)
+    log_handler = DroppingQueueHandler(records)
+    logging.getLogger("cchat").addHandler(log_handler)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    log_listener = logging.handlers.QueueListener(records, stream_handler)
+    log_listener.start()
+
+#write the records still queued and stop the writer thread
+def stop_logging():
+    global log_handler, log_listener
+    if log_listener != None:
+        log_listener.stop()
+        logging.getLogger("cchat").removeHandler(log_handler)
+        log_listener = None
+
+def main():
+    #routing mode can be selected with --link-state anywhere on the command line
+    link_state = "--link-state" in sys.argv
+    if link_state:
+        sys.argv.remove("--link-state")
+    #fast neighbour failure detection with --detect <probe interval ms>
+    probe_interval = None
+    if "--detect" in sys.argv[:-1]:
+        index = sys.argv.index("--detect")
+        probe_interval = int(sys.argv[index + 1])
+        del sys.argv[index:index + 2]
+        if not SendAndReceive.probe_interval_range[0] <= probe_interval <= SendAndReceive.probe_interval_range[1]:
+            print("probe interval must be %d to %d ms" % SendAndReceive.probe_interval_range)
+            return
+    #largest datagram the node takes with --mtu <bytes>
+    mtu = max_packet_limit
+    if "--mtu" in sys.argv[:-1]:
+        index = sys.argv.index("--mtu")
+        mtu = int(sys.argv[index + 1])
+        del sys.argv[index:index + 2]
+        if not packet_limit <= mtu <= udp_limit:
+            print("mtu must be %d to %d bytes" % (packet_limit, udp_limit))
+            return
+    #stats endpoint with --stats <port or UNIX socket path>
+    stats_address = None
+    if "--stats" in sys.argv[:-1]:
+        index = sys.argv.index("--stats")
+        stats_address = sys.argv[index + 1]
+        del sys.argv[index:index + 2]
+    #log levels with --log <subsystem>=<level>[,<subsystem>=<level>]...
+    if "--log" in sys.argv[:-1]:
+        index = sys.argv.index("--log")
+        settings = [setting.split("=", 1) for setting in sys.argv[index + 1].split(",")]
+        if not all(len(setting) == 2 and (setting[0] == "all" or setting[0] in subsystems) and \
+            setting[1] in log_levels for setting in settings):
+            print("--log takes <subsystem>=<level>,... with subsystem " + "|".join(["all"] + list(subsystems)) + \
+                " and level " + "|".join(log_levels))
+            return
+        for setting in settings:
+            set_log_level(*setting)
+        del sys.argv[index:index + 2]
+    print("length:", str(len(sys.argv)))
+    print("argv:", sys.argv)
+
+    # neighbor can be set only on command line
+    # parse command line
+    if (len(sys.argv) >= 5):
+
+        if (len(bytes().fromhex(sys.argv[3])) == 8):
+
+            #initialize all classes
+            start_logging()
+            send_receive = SendAndReceive((sys.argv[1], int(sys.argv[2])), bytes().fromhex(sys.argv[3]), sys.argv[4])
+            send_receive.stats_address = stats_address
+            send_receive.mtu = mtu
+            if probe_interval != None:
+                send_receive.set_probe_interval(probe_interval)
+            routing_manager = RoutingManager(send_receive, bytes().fromhex(sys.argv[3]), link_state)
+            packet_manager = PacketManager(routing_manager, bytes().fromhex(sys.argv[3]), sys.argv[4])
+            routing_manager.set_packet_manager(packet_manager)
+            send_receive.set_routing_manager(routing_manager)
+            send_receive.set_packet_manager(packet_manager)
+            keyboard = Keyboard(send_receive)
+            keyboard.daemon = True
+
+            #parse neighbours from command line
+            try:
+
+                if (len(sys.argv) >= 8 and len(sys.argv) % 3 == 2):
+                    for i in range(5, len(sys.argv), 3):
+                        host = sys.argv[i]
+                        port = sys.argv[i + 1]
+                        longid = sys.argv[i + 2]
+                        print("adding neighbour host:" + host + " port:" + port + " longid:" + longid)
+                        ipaddress = socket.gethostbyname_ex(host)
+                        longidbytes = bytes().fromhex(longid)
+                        if (len(longidbytes) == 8):
+                            host_port = (host, int(port))
+                            send_receive.neighbours[longidbytes]=host_port
+                            routing_manager.add_neighbour(host_port,longidbytes)
+                        else:
+                            print("longid must be 8 bytes:" + sys.argv[i + 2])
 
-            if (len(sys.argv) >= 8 and len(sys.argv) % 3 == 2):
-                for i in range(5, len(sys.argv), 3):
-                    host = sys.argv[i]
-                    port = sys.argv[i + 1]
-                    longid = sys.argv[i + 2]
-                    print("adding neighbour host:" + host + " port:" + port + " longid:" + longid)
-                    ipaddress = socket.gethostbyname_ex(host)
-                    longidbytes = bytes().fromhex(longid)
-                    if (len(longidbytes) == 8):
-                        host_port = (host, int(port))
-                        send_receive.neighbours[longidbytes]=host_port
-                        routing_manager.add_neighbour(host_port,longidbytes)
-                    else:
-                        print("longid must be 8 bytes:" + sys.argv[i + 2])
-
-            keyboard.start()
-
-            #start the main loop
-            send_receive.start()
+                keyboard.start()
 
-        except Exception as error:
-            send_receive.exit()
-            keyboard.exit()
-            raise error
+                #start the main loop
+                send_receive.start()
+
+            except Exception as error:
+                send_receive.exit()
+                keyboard.exit()
+                raise error
+            finally:
+                stop_logging()
 
 
+        else:
+            print("longid must be 8 bytes:" + sys.argv[3])
+
     else:
-        print("longid must be 8 bytes:" + sys.argv[3])
+        help()
+
 
-else:
-    help()
+if __name__ == "__main__":
+    main()
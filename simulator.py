@@ -0,0 +1,300 @@
+#in-process network simulator, runs many cchat nodes on one event loop over an in-memory transport with
+#loss, delay and reordering, and reports route convergence time, message throughput and end-to-end latency
+#time is simulated, the results do not depend on how fast this process runs hundreds of nodes
+#usage: python simulator.py [--topology ring|grid|mesh] [--nodes N] [--loss P] [--delay MS] [--jitter MS]
+#                           [--reorder P] [--messages N] [--rate N] [--link-state] [--seed N]
+
+import os
+import sys
+import time
+import heapq
+import random
+import argparse
+import contextlib
+
+import cchat
+
+#event loop with simulated time, the part of asyncio the nodes use
+class SimulatedLoop(object):
+
+    def __init__(self):
+        self.clock = 0.0
+        self.events = []
+        self.counter = 0
+        self.closed = False
+
+    def time(self):
+        return self.clock
+
+    def call_at(self, when, callback, *args):
+        handle = SimulatedHandle(max(when, self.clock), callback, args)
+        self.counter += 1
+        heapq.heappush(self.events, (handle.deadline, self.counter, handle))
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.clock + delay, callback, *args)
+
+    def call_soon(self, callback, *args):
+        return self.call_at(self.clock, callback, *args)
+
+    call_soon_threadsafe = call_soon
+
+    #run the events due until limit, the clock ends at limit
+    def run(self, limit):
+        while len(self.events) > 0 and self.events[0][0] <= limit:
+            (self.clock, counter, handle) = heapq.heappop(self.events)
+            if not handle.cancelled:
+                handle.callback(*handle.args)
+        self.clock = max(self.clock, limit)
+
+    def is_closed(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+        self.events = []
+
+class SimulatedHandle(object):
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def when(self):
+        return self.deadline
+
+    def cancel(self):
+        self.cancelled = True
+
+#in-memory replacement of BatchDatagramTransport, datagrams go through the network
+class SimulatedTransport(object):
+
+    def __init__(self, network, address, protocol):
+        self.network = network
+        self.address = address
+        self.protocol = protocol
+        protocol.connection_made(self)
+
+    def sendto(self, data, addr):
+        self.network.transmit(self.address, addr, bytes(data))
+
+    def close(self):
+        pass
+
+class SimulatedNode(object):
+
+    def __init__(self, network, index, link_state):
+        self.longid = index.to_bytes(8, byteorder='big')
+        self.address = ("sim", index)
+        self.send_receive = cchat.SendAndReceive(self.address, self.longid, "n" + str(index), network.loop)
+        self.routing_manager = cchat.RoutingManager(self.send_receive, self.longid, link_state)
+        self.packet_manager = cchat.PacketManager(self.routing_manager, self.longid, "n" + str(index))
+        self.routing_manager.set_packet_manager(self.packet_manager)
+        self.send_receive.set_routing_manager(self.routing_manager)
+        self.send_receive.set_packet_manager(self.packet_manager)
+        self.packet_manager.on_screen_message = network.message_received
+        self.protocol = cchat.NodeProtocol(self.send_receive)
+        SimulatedTransport(network, self.address, self.protocol)
+
+    #configure a neighbour, as main() does for neighbours on the command line
+    def add_neighbour(self, other):
+        self.send_receive.neighbours[other.longid] = other.address
+        self.routing_manager.add_neighbour(other.address, other.longid)
+
+    def send_message(self, destination, text):
+        message = cchat.ScreenMessage(self.longid, destination, self.packet_manager.get_send_session_id(destination), text)
+        self.routing_manager.send(message, destination)
+
+class SimulatedNetwork(object):
+
+    #loss and reorder are probabilities, delay and jitter in ms, a reordered datagram is held back 2 * delay more
+    def __init__(self, loss=0.0, delay=1.0, jitter=0.0, reorder=0.0):
+        self.loop = SimulatedLoop()
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.nodes = {} # address = SimulatedNode
+        self.reach = {} # address = the other nodes it can have a route to
+        self.counters = {"datagrams": 0, "lost": 0, "reordered": 0}
+        self.sent = {} # message text = send time
+        self.last_transmit = 0.0
+        self.latencies = [] # ms
+
+    def build(self, count, links, link_state=False):
+        nodes = [SimulatedNode(self, index, link_state) for index in range(1, count + 1)]
+        for node in nodes:
+            self.nodes[node.address] = node
+        for (a, b) in links:
+            nodes[a].add_neighbour(nodes[b])
+            nodes[b].add_neighbour(nodes[a])
+        #distance vector does not reach past max_hopcount
+        limit = None if link_state else cchat.RoutingManager.max_hopcount
+        for (index, node) in enumerate(nodes):
+            self.reach[node.address] = [nodes[other] for other in reachable(index, links, limit) if other != index]
+        for node in nodes:
+            node.send_receive.start_timers()
+        return nodes
+
+    def transmit(self, source, destination, data):
+        self.counters["datagrams"] += 1
+        self.last_transmit = self.loop.time()
+        node = self.nodes.get(destination)
+        if node == None or random.random() < self.loss:
+            self.counters["lost"] += 1
+            return
+        delay = self.delay + random.uniform(0, self.jitter)
+        if random.random() < self.reorder:
+            self.counters["reordered"] += 1
+            delay += 2 * self.delay
+        self.loop.call_later(delay / 1000, node.protocol.datagram_received, data, source)
+
+    def message_received(self, source, message):
+        sent = self.sent.pop(message, None)
+        if sent != None:
+            self.latencies.append((self.loop.time() - sent) * 1000)
+
+    def converged(self):
+        return all(len(node.routing_manager.distance_table) == len(self.reach[address]) + 1 \
+            for (address, node) in self.nodes.items())
+
+    #seconds until every node has a route to every node it can reach, None if that did not happen within timeout
+    def wait_converged(self, timeout):
+        start = self.loop.time()
+        while not self.converged():
+            if self.loop.time() - start > timeout:
+                return None
+            self.loop.run(self.loop.time() + 0.05)
+        return self.loop.time() - start
+
+    #seconds until no datagram was sent for quiet seconds (identity exchanges and route updates are done)
+    def wait_quiet(self, quiet, timeout):
+        start = self.loop.time()
+        while self.loop.time() - self.last_transmit < quiet and self.loop.time() - start < timeout:
+            self.loop.run(self.loop.time() + quiet / 4)
+        return self.loop.time() - start
+
+    #send messages between random pairs of nodes that can reach each other at rate per second, wait until they arrive or timeout
+    #returns the seconds from the first message sent to the last one received
+    def run_load(self, messages, rate, timeout):
+        nodes = list(self.nodes.values())
+        start = self.loop.time()
+        for i in range(messages):
+            source = random.choice(nodes)
+            destination = random.choice(self.reach[source.address])
+            text = "sim:" + str(i)
+            self.sent[text] = self.loop.time()
+            source.send_message(destination.longid, text)
+            if i % 10 == 9:
+                self.loop.run(self.loop.time() + 10 / rate)
+        while len(self.sent) > 0 and self.loop.time() - start < timeout:
+            self.loop.run(self.loop.time() + 0.01)
+        return self.loop.time() - start
+
+    def close(self):
+        for node in self.nodes.values():
+            node.send_receive.do_exit = True
+        self.loop.close()
+
+def ring(count):
+    return [(i, (i + 1) % count) for i in range(count)]
+
+#rows x columns grid, as square as count allows
+def grid(count):
+    columns = max(1, int(count ** 0.5))
+    links = []
+    for i in range(count):
+        if (i + 1) % columns != 0 and i + 1 < count:
+            links.append((i, i + 1))
+        if i + columns < count:
+            links.append((i, i + columns))
+    return links
+
+#ring with random chords, about 4 links per node (all pairs for small counts)
+def mesh(count):
+    links = set(ring(count))
+    while len(links) < min(count * 2, count * (count - 1) // 2):
+        (a, b) = random.sample(range(count), 2)
+        if (b, a) not in links:
+            links.add((a, b))
+    return sorted(links)
+
+#indexes of the nodes at most limit hops from start (any distance if limit is None)
+def reachable(start, links, limit):
+    adjacent = {}
+    for (a, b) in links:
+        adjacent.setdefault(a, set()).add(b)
+        adjacent.setdefault(b, set()).add(a)
+    distance = {start: 0}
+    queue = [start]
+    for node in queue:
+        if limit != None and distance[node] >= limit:
+            continue
+        for other in adjacent.get(node, ()):
+            if other not in distance:
+                distance[other] = distance[node] + 1
+                queue.append(other)
+    return distance
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main():
+    parser = argparse.ArgumentParser(description="cChat network simulator")
+    parser.add_argument("--topology", choices=["ring", "grid", "mesh"], default="mesh")
+    parser.add_argument("--nodes", type=int, default=50)
+    parser.add_argument("--loss", type=float, default=0.0, help="datagram loss probability")
+    parser.add_argument("--delay", type=float, default=1.0, help="link delay in ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra delay in ms")
+    parser.add_argument("--reorder", type=float, default=0.0, help="probability a datagram is held back")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=500.0, help="messages per second")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds for convergence and for the load")
+    parser.add_argument("--link-state", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if args.nodes < 2:
+        parser.error("--nodes must be at least 2, messages are sent between nodes")
+
+    random.seed(args.seed)
+    network = SimulatedNetwork(args.loss, args.delay, args.jitter, args.reorder)
+    links = {"ring": ring, "grid": grid, "mesh": mesh}[args.topology](args.nodes)
+    #the nodes print received messages and tables, and log neighbours and identities
+    cchat.set_log_level("all", "off")
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        network.build(args.nodes, links, args.link_state)
+        cpu = time.process_time()
+        convergence = network.wait_converged(args.timeout)
+        datagrams = network.counters["datagrams"]
+        duration = None
+        if convergence != None:
+            settle = network.wait_quiet(0.2, args.timeout)
+            load_datagrams = network.counters["datagrams"]
+            duration = network.run_load(args.messages, args.rate, args.timeout)
+            load_datagrams = network.counters["datagrams"] - load_datagrams
+        cpu = time.process_time() - cpu
+    network.close()
+
+    print("topology:", args.topology, "nodes:", args.nodes, "links:", len(links), \
+        "routing:", "link state" if args.link_state else "distance vector")
+    print("loss:", args.loss, "delay:", args.delay, "ms jitter:", args.jitter, "ms reorder:", args.reorder)
+    if convergence == None:
+        print("routes did not converge in", args.timeout, "s")
+        return
+    print("convergence: {:.2f} s, {} datagrams, quiet {:.2f} s later".format(convergence, datagrams, settle))
+    delivered = len(network.latencies)
+    print("messages: {} sent, {} delivered in {:.2f} s, {:.0f} messages/s, {} datagrams".format(args.messages, \
+        delivered, duration, delivered / duration, load_datagrams))
+    print("latency ms: p50 {:.1f} p90 {:.1f} p99 {:.1f} max {:.1f}".format(percentile(network.latencies, 0.5), \
+        percentile(network.latencies, 0.9), percentile(network.latencies, 0.99), percentile(network.latencies, 1.0)))
+    print("datagrams: {} sent, {} lost, {} reordered, cpu {:.1f} s".format(network.counters["datagrams"], \
+        network.counters["lost"], network.counters["reordered"], cpu))
+
+if __name__ == "__main__":
+    main()
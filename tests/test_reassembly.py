@@ -0,0 +1,99 @@
+#reassembly of fragments that come duplicated, out of order, or do not fit the fragments of the message
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import cchat
+
+source = (1).to_bytes(8, byteorder='big')
+destination = (2).to_bytes(8, byteorder='big')
+
+def fragments(data, size, session_id=1):
+    return cchat.PacketCollection(0x06, source, destination, session_id, data).get_packets(size)
+
+def fragment(flags, seq, data, session_id=1):
+    return cchat.Packet(0x06, flags, source, destination, session_id, seq, data)
+
+class ReassemblyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = bytes(random.Random(1).getrandbits(8) for i in range(1000))
+
+    def reassemble(self, packets):
+        reassembly = cchat.Reassembly(packets[0])
+        stored = [reassembly.add(packet) for packet in packets]
+        return (reassembly, stored)
+
+    def test_in_order(self):
+        (reassembly, stored) = self.reassemble(fragments(self.data, 128))
+        self.assertTrue(reassembly.is_complete())
+        self.assertEqual(sum(stored), len(self.data))
+        self.assertEqual(reassembly.get_packet_collection().data, self.data)
+
+    def test_shuffled_with_duplicates(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            packets = fragments(self.data, 100)
+            packets = packets + rng.sample(packets, 5)
+            rng.shuffle(packets)
+            (reassembly, stored) = self.reassemble(packets)
+            self.assertTrue(reassembly.is_complete())
+            self.assertEqual(sum(stored), len(self.data))
+            self.assertEqual(stored.count(0), 5)
+            self.assertEqual(reassembly.get_packet_collection().data, self.data)
+
+    def test_last_fragment_first(self):
+        packets = fragments(self.data, 300)
+        (reassembly, stored) = self.reassemble(packets[::-1])
+        self.assertTrue(reassembly.is_complete())
+        self.assertEqual(reassembly.get_packet_collection().data, self.data)
+
+    def test_incomplete(self):
+        packets = fragments(self.data, 100)
+        (reassembly, stored) = self.reassemble(packets[:4] + packets[5:])
+        self.assertFalse(reassembly.is_complete())
+        self.assertEqual(reassembly.received, 900)
+
+    #fragments of another size overlap the ones of the message and are dropped, it is still put together right
+    def test_overlapping_dropped(self):
+        packets = fragments(self.data, 100)
+        reassembly = cchat.Reassembly(packets[0])
+        self.assertEqual(reassembly.add(packets[0]), 100)
+        #other size, off the grid, empty, or past the end
+        self.assertEqual(reassembly.add(fragment(0x00, 250, self.data[200:250])), 0)
+        self.assertEqual(reassembly.add(fragment(0x00, 250, self.data[150:250])), 0)
+        self.assertEqual(reassembly.add(fragment(0x00, 200, b"")), 0)
+        self.assertEqual(reassembly.add(fragment(0x00, 50, self.data[0:100])), 0)
+        for packet in packets[1:]:
+            self.assertEqual(reassembly.add(packet), len(packet.data))
+        self.assertEqual(reassembly.add(fragment(0x00, 1100, bytes(100))), 0)
+        self.assertTrue(reassembly.is_complete())
+        self.assertEqual(reassembly.get_packet_collection().data, self.data)
+
+    #a last fragment that does not end where the first one said, or with fragments after it, is dropped
+    def test_conflicting_last_fragment(self):
+        packets = fragments(self.data, 100)
+        reassembly = cchat.Reassembly(packets[0])
+        reassembly.add(packets[-1])
+        self.assertEqual(reassembly.add(fragment(0x02, 950, self.data[900:950])), 0)
+        self.assertEqual(reassembly.add(fragment(0x02, 1000, self.data[950:1000])), 0)
+        reassembly = cchat.Reassembly(packets[0])
+        reassembly.add(packets[5])
+        self.assertEqual(reassembly.add(fragment(0x02, 500, self.data[400:500])), 0)
+        #a last fragment that came first fixes the grid of the others
+        reassembly = cchat.Reassembly(packets[0])
+        reassembly.add(fragment(0x02, 1000, self.data[960:1000]))
+        self.assertEqual(reassembly.add(fragment(0x00, 100, self.data[0:100])), 0)
+        self.assertEqual(reassembly.add(fragment(0x00, 240, self.data[0:240])), 240)
+
+    def test_init_with_packets(self):
+        packets = fragments(self.data, 200)
+        collection = cchat.PacketCollection.init_with_packets(packets[::-1])
+        self.assertEqual(collection.data, self.data)
+        with self.assertRaises(Exception):
+            cchat.PacketCollection.init_with_packets(packets[1:])
+
+if __name__ == "__main__":
+    unittest.main()
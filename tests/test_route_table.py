@@ -0,0 +1,155 @@
+#compact route tables: encode and decode, and deltas from get_routing_table_since merged by merge_neighbour_table
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import cchat
+
+def longid(value):
+    return value.to_bytes(8, byteorder='big')
+
+def random_routes(rng, count):
+    destinations = set(rng.getrandbits(64) for i in range(count))
+    return sorted((longid(destination), rng.choice([0, 1, 2, 3, 15, 0xFFFF])) for destination in destinations)
+
+def build_node(id):
+    send_receive = cchat.SendAndReceive(("localhost", 5000), id, "test")
+    routing_manager = cchat.RoutingManager(send_receive, id)
+    packet_manager = cchat.PacketManager(routing_manager, id, "test")
+    routing_manager.set_packet_manager(packet_manager)
+    send_receive.set_routing_manager(routing_manager)
+    send_receive.set_packet_manager(packet_manager)
+    return routing_manager
+
+class EncodeRouteTableTest(unittest.TestCase):
+
+    def round_trip(self, epoch, version, base, routes):
+        data = cchat.encode_route_table(epoch, version, base, routes)
+        self.assertTrue(cchat.is_route_table(data))
+        self.assertNotEqual(len(data) % 10, 0)
+        self.assertEqual(cchat.decode_route_table(data), ((epoch, version, base), sorted(routes)))
+        return data
+
+    def test_empty(self):
+        self.round_trip(0, 0, None, [])
+        self.round_trip(0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF, [])
+
+    def test_random(self):
+        rng = random.Random(1)
+        for count in (1, 2, 5, 20, 100, 1000):
+            for base in (None, 0, 300, 0xFFFFFFFF):
+                self.round_trip(rng.getrandbits(32), rng.getrandbits(32), base, random_routes(rng, count))
+
+    #large tables are compressed, ids that are close together take few bytes
+    def test_compressed(self):
+        routes = [(longid(0x0101010100000000 + index), 2) for index in range(1000)]
+        data = self.round_trip(7, 8, None, routes)
+        self.assertTrue(data[1] & cchat.route_table_compressed)
+        self.assertLess(len(data), 1000)
+        data = self.round_trip(7, 8, 5, routes)
+        self.assertTrue(data[1] & cchat.route_table_compressed)
+        self.assertTrue(data[1] & cchat.route_table_delta)
+
+class RouteTableDeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sender = build_node(longid(1))
+        self.receiver = build_node(longid(2))
+        self.requests = []
+        #the full update requests are recorded, not sent
+        self.receiver.packet_manager.request_send_fullrouting_update = self.requests.append
+
+    def tearDown(self):
+        self.sender.send_receive.loop.close()
+        self.receiver.send_receive.loop.close()
+
+    #sender changes the hop count of destinations (None removes them) as a new table version
+    def change(self, routes):
+        for (destination, hopcount) in routes.items():
+            if hopcount == None:
+                self.sender.distance_table.pop(longid(destination), None)
+            else:
+                self.sender.distance_table[longid(destination)] = hopcount
+        self.sender.log_route_changes([longid(destination) for destination in routes])
+
+    #table from sender to receiver over the wire format, returns the routes merged
+    def transfer(self, known_version):
+        (table_version, routes) = self.sender.get_routing_table_since(self.receiver.id, known_version)
+        data = cchat.encode_route_table(table_version[0], table_version[1], table_version[2], routes)
+        (table_version, routes) = cchat.decode_route_table(data)
+        return (table_version, self.receiver.merge_neighbour_table(self.sender.id, table_version, routes))
+
+    def known_version(self):
+        table = self.receiver.neighbour_tables.get(self.sender.id)
+        return None if table == None else (table[0], table[1])
+
+    def received_table(self):
+        return self.receiver.neighbour_tables[self.sender.id][2]
+
+    def sender_table(self):
+        return dict(self.sender.get_routing_table(self.receiver.id))
+
+    def test_full_then_deltas(self):
+        rng = random.Random(3)
+        self.change(dict((destination, rng.randint(1, 10)) for destination in range(3, 100)))
+        (table_version, merged) = self.transfer(None)
+        self.assertEqual(table_version[2], None)
+        self.assertEqual(self.received_table(), self.sender_table())
+        for step in range(30):
+            self.change(dict((rng.randint(3, 120), rng.choice([None, 1, 2, 5])) for i in range(rng.randint(1, 5))))
+            if step % 3 == 0:
+                self.change({rng.randint(3, 120): 4})
+            (table_version, merged) = self.transfer(self.known_version())
+            #a delta with only the changes, merged is the whole table as the receiver has it now
+            self.assertIsNotNone(table_version[2])
+            self.assertEqual(dict((destination, hopcount) for (destination, hopcount) in merged \
+                if hopcount != 0xFFFF), self.received_table())
+            expected = dict((destination, hopcount) for (destination, hopcount) in self.sender_table().items() \
+                if hopcount != 0xFFFF)
+            self.assertEqual(self.received_table(), expected)
+        self.assertEqual(self.requests, [])
+
+    #the changes are no longer all in the log, the whole table is sent
+    def test_log_overflow(self):
+        self.change({3: 1})
+        self.transfer(None)
+        version = self.known_version()
+        self.sender.route_log = cchat.collections.deque(self.sender.route_log, maxlen=4)
+        for destination in range(4, 10):
+            self.change({destination: 2})
+        (table_version, merged) = self.transfer(version)
+        self.assertEqual(table_version[2], None)
+        self.assertEqual(self.received_table(), self.sender_table())
+
+    def test_base_mismatch(self):
+        self.change({3: 1, 4: 2})
+        self.transfer(None)
+        self.change({5: 3})
+        (table_version, routes) = self.sender.get_routing_table_since(self.receiver.id, self.known_version())
+        self.change({3: 4})
+        (newer_version, newer_routes) = self.sender.get_routing_table_since(self.receiver.id, self.known_version())
+        #two answers to the same request, the first one is applied and the second one is on an older base
+        self.receiver.merge_neighbour_table(self.sender.id, table_version, routes)
+        self.assertEqual(self.received_table()[longid(5)], 3)
+        self.assertEqual(self.receiver.merge_neighbour_table(self.sender.id, newer_version, newer_routes), [])
+        self.assertEqual(self.received_table()[longid(3)], 1)
+        #it is newer than the table we have, the changes since our version are asked for again
+        self.assertEqual(self.requests, [self.sender.id])
+        (table_version, merged) = self.transfer(self.known_version())
+        self.assertEqual(table_version[2], table_version[1] - 1)
+        self.assertEqual(self.received_table(), self.sender_table())
+        #a delta of another epoch (the sender restarted) is dropped too
+        (epoch, version, base) = table_version
+        self.assertEqual(self.receiver.merge_neighbour_table(self.sender.id, (epoch + 1, version + 1, version), \
+            [(longid(3), 1)]), [])
+        self.assertEqual(len(self.requests), 2)
+        #an older delta is dropped without asking again
+        self.assertEqual(self.receiver.merge_neighbour_table(self.sender.id, (epoch, version - 1, version - 2), \
+            [(longid(3), 1)]), [])
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.received_table(), self.sender_table())
+
+if __name__ == "__main__":
+    unittest.main()
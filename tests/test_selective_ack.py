@@ -0,0 +1,124 @@
+#selective acks: the cumulative offset and bitmap the receiver sends, and the fragments the sender clears with them
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import cchat
+
+own_id = (1).to_bytes(8, byteorder='big')
+other_id = (2).to_bytes(8, byteorder='big')
+
+def fragments(length, size, session_id=1):
+    return cchat.PacketCollection(0x06, own_id, other_id, session_id, bytes(length)).get_packets(size)
+
+def bits(bitmap):
+    return [index for index in range(len(bitmap) * 8) if (bitmap[index // 8] >> (index % 8)) & 1 == 1]
+
+class SelectiveAckTest(unittest.TestCase):
+
+    def receive(self, packets):
+        selective_ack = cchat.SelectiveAck(packets[0])
+        for packet in packets:
+            selective_ack.add(packet)
+        ack = selective_ack.get_ack_packet()
+        self.assertEqual(ack.packet_flags, 0x05)
+        self.assertEqual((ack.source, ack.destination), (other_id, own_id))
+        return (selective_ack, ack.seq, int.from_bytes(ack.data[0:2], byteorder='big'), ack.data[2:])
+
+    def test_in_order(self):
+        packets = fragments(1000, 100)
+        (selective_ack, cumulative, size, bitmap) = self.receive(packets)
+        self.assertEqual((cumulative, size, bitmap), (1000, 100, b""))
+        self.assertTrue(selective_ack.is_complete())
+
+    def test_gaps(self):
+        packets = fragments(1000, 100)
+        (selective_ack, cumulative, size, bitmap) = self.receive(packets[0:2] + packets[3:5] + packets[9:])
+        self.assertEqual((cumulative, size), (200, 100))
+        #bit 0 is the fragment at the cumulative offset, it is missing
+        self.assertEqual(bits(bitmap), [1, 2, 7])
+        self.assertFalse(selective_ack.is_complete())
+
+    def test_duplicates_and_order(self):
+        packets = fragments(1000, 100)
+        (selective_ack, cumulative, size, bitmap) = self.receive(packets[::-1][:-1] + packets[5:7])
+        self.assertEqual(cumulative, 0)
+        self.assertEqual(bits(bitmap), list(range(1, 10)))
+        selective_ack.add(packets[0])
+        self.assertTrue(selective_ack.is_complete())
+        self.assertEqual(selective_ack.get_ack_packet().seq, 1000)
+
+    #fragments further than the bitmap reaches are left out, they are acked when the cumulative offset moves up
+    def test_bitmap_limit(self):
+        reach = cchat.SelectiveAck.max_bitmap * 8
+        packets = fragments(10 * (reach + 10), 10)
+        (selective_ack, cumulative, size, bitmap) = self.receive(packets[1:])
+        self.assertEqual(len(bitmap), cchat.SelectiveAck.max_bitmap)
+        self.assertEqual(bits(bitmap), list(range(1, reach)))
+
+class ReceiveSelectiveAckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.send_receive = cchat.SendAndReceive(("localhost", 5000), own_id, "test")
+        routing_manager = cchat.RoutingManager(self.send_receive, own_id)
+        packet_manager = cchat.PacketManager(routing_manager, own_id, "test")
+        routing_manager.set_packet_manager(packet_manager)
+        self.send_receive.set_routing_manager(routing_manager)
+        self.send_receive.set_packet_manager(packet_manager)
+
+    def tearDown(self):
+        self.send_receive.loop.close()
+
+    #our message of length bytes in fragments of size, waiting for acks
+    def send(self, length, size, session_id=1):
+        packets = fragments(length, size, session_id)
+        self.send_receive.open_messages[(other_id, session_id)] = (length, size)
+        for packet in packets:
+            self.send_receive.open_sessions[(other_id, session_id)] = \
+                self.send_receive.open_sessions.get((other_id, session_id), 0) + 1
+            self.send_receive.add_ack_info((other_id, session_id, packet.seq), packet, 0)
+        return packets
+
+    def outstanding(self, session_id=1):
+        return sorted(self.send_receive.ack_sessions.get((other_id, session_id), []))
+
+    def ack(self, cumulative, size, bitmap, session_id=1):
+        self.send_receive.receive_selective_ack(cchat.Packet(0x06, 0x05, other_id, own_id, session_id, cumulative, \
+            size.to_bytes(2, byteorder='big') + bytes(bitmap)))
+
+    def test_round_trip(self):
+        packets = self.send(1000, 100)
+        selective_ack = cchat.SelectiveAck(packets[0])
+        for index in (0, 1, 3, 4, 9):
+            selective_ack.add(packets[index])
+        self.send_receive.receive_selective_ack(selective_ack.get_ack_packet())
+        self.assertEqual(self.outstanding(), [300, 600, 700, 800, 900])
+        for index in (2, 5, 6, 7, 8):
+            selective_ack.add(packets[index])
+        self.send_receive.receive_selective_ack(selective_ack.get_ack_packet())
+        self.assertEqual(self.outstanding(), [])
+        #the session id is in quarantine, not given out again yet
+        self.assertIn((other_id, 1), self.send_receive.closed_sessions)
+        self.assertNotIn((other_id, 1), self.send_receive.open_sessions)
+
+    #a bit for a short last fragment acks it, the bitmap reaches past the cumulative offset
+    def test_short_last_fragment(self):
+        self.send(950, 100)
+        self.ack(500, 100, [0b10000])
+        self.assertEqual(self.outstanding(), [600, 700, 800, 900])
+
+    def test_rejected(self):
+        self.send(1000, 100)
+        #cumulative offset past the message or inside a fragment, another fragment size, a bit past the end
+        for (cumulative, size, bitmap) in [(1100, 100, []), (150, 100, []), (100, 50, [1]), (500, 100, [0, 0b1000])]:
+            self.ack(cumulative, size, bitmap)
+        self.assertEqual(self.send_receive.metrics.counters["selective_acks_rejected"], 4)
+        self.assertEqual(len(self.outstanding()), 10)
+        #the last bit that fits the message
+        self.ack(500, 100, [0b10000])
+        self.assertEqual(self.send_receive.metrics.counters["selective_acks_rejected"], 4)
+        self.assertEqual(self.outstanding(), [600, 700, 800, 900])
+
+if __name__ == "__main__":
+    unittest.main()
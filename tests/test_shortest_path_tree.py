@@ -0,0 +1,74 @@
+#incremental shortest path tree (set_edge) against a full recompute (rebuild) on random graphs
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import cchat
+
+#the tree must be a shortest path tree: distances as a full recompute has them, every node reached over its
+#parent with that distance, and the first hop the one of the parent (the node itself below the source)
+#first hops are not compared directly, with equal cost paths both trees can pick another one
+def check_tree(test, tree, expected):
+    test.assertEqual(tree.distance, expected.distance)
+    for (node, parent) in tree.parent.items():
+        if parent == None:
+            test.assertEqual(node, tree.source)
+            continue
+        test.assertEqual(tree.distance[parent] + tree.edges[parent][node], tree.distance[node])
+        test.assertIn(node, tree.children[parent])
+        test.assertEqual(tree.first_hop[node], node if parent == tree.source else tree.first_hop[parent])
+    test.assertEqual(set(tree.first_hop), set(tree.distance))
+
+def full_recompute(tree):
+    expected = cchat.ShortestPathTree(tree.source)
+    for (u, neighbours) in tree.edges.items():
+        for (v, weight) in neighbours.items():
+            expected.set_edge(u, v, weight)
+    expected.rebuild()
+    return expected
+
+class ShortestPathTreeTest(unittest.TestCase):
+
+    def test_random_changes(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            nodes = list(range(12))
+            tree = cchat.ShortestPathTree(0)
+            for step in range(200):
+                (u, v) = rng.sample(nodes, 2)
+                #add, change and remove edges, weights of 1 give many equal cost paths
+                weight = None if rng.random() < 0.3 else rng.choice([1, 1, 2, 3, 5])
+                if weight == None and v not in tree.edges.get(u, {}):
+                    continue
+                tree.set_edge(u, v, weight)
+                check_tree(self, tree, full_recompute(tree))
+
+    def test_changes_reported(self):
+        tree = cchat.ShortestPathTree(0)
+        tree.set_edge(0, 1, 1)
+        tree.set_edge(1, 2, 1)
+        self.assertEqual(tree.get_changes(), {1, 2})
+        self.assertEqual(tree.get_changes(), set())
+        #2 moves to its own first hop, 1 is untouched
+        tree.set_edge(0, 2, 1)
+        self.assertEqual(tree.get_changes(), {2})
+        self.assertEqual(tree.first_hop[2], 2)
+        #2 is cut off from the tree and reached over 1 again
+        tree.set_edge(0, 2, None)
+        self.assertEqual(tree.get_changes(), {2})
+        self.assertEqual((tree.distance[2], tree.first_hop[2]), (2, 1))
+
+    def test_partition(self):
+        tree = cchat.ShortestPathTree(0)
+        for (u, v) in [(0, 1), (1, 2), (2, 3), (0, 4)]:
+            tree.set_edge(u, v, 1)
+        tree.get_changes()
+        tree.set_edge(0, 1, None)
+        self.assertEqual(tree.distance, {0: 0, 4: 1})
+        self.assertEqual(tree.get_changes(), {1, 2, 3})
+        check_tree(self, tree, full_recompute(tree))
+
+if __name__ == "__main__":
+    unittest.main()